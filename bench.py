@@ -0,0 +1,448 @@
+"""A stand-alone script to benchmark the Dojo storage paths.
+
+Usage:
+    python bench.py ingest [ticks] [comments_per_tick]
+        compares per-row and batched ingestion against the Postgres database at DATABASE_URL
+    python bench.py backends [ticks] [comments_per_tick]
+        runs ingestion, tallying, the health check and cleanup against every storage backend (Postgres
+        only if DATABASE_URL is set)
+    python bench.py workflows [num_comments ...] [--backend sqlite|memory|postgres]
+        runs the Dojo and sidebar workflows end to end on generated Dojo threads (default: 10000 and
+        100000 comments), against the fake Reddit and Twitch APIs of fakes.py and a local database.
+        Timings and API call counts are appended to bench_results.jsonl with the current commit and
+        compared with the last run of an earlier commit
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from psycopg2 import sql
+
+import db
+import dojo
+import fakes
+import redesign
+import storage
+import tasks
+import twitch
+from storage import BatchResult, CommentRecord
+
+BENCH_TABLE_NAME = "dojo_comments_bench"
+BENCH_SCORES_TABLE_NAME = "dojo_scores_bench"
+BENCH_STATE_TABLE_NAME = "bot_state_bench"
+BENCH_MASTERS_TABLE_NAME = "dojo_masters_bench"
+DUPLICATE_RATIO = 0.2  # fraction of each tick already ingested on the previous tick
+DELETED_RATIO = 0.05  # fraction of comments the health check finds deleted
+WORKFLOW_SIZES = [10000, 100000]  # comments in the generated Dojo threads
+TICK_SIZE = 100  # comments per stream tick, a full page of the comment listing
+TALLY_REPEATS = 20  # tally_scores runs averaged over
+NUM_FLAIRED_USERS = 20000  # users with a flair, listed when awarding the Dojo Master
+PREVIOUS_MASTERS = 3  # users still flaired as Dojo Master from the month before
+TWITCH_GAME_ID = "461067"  # Tekken 7
+RESULTS_PATH = "bench_results.jsonl"
+
+logging.basicConfig(level=logging.ERROR)
+
+
+class FakeComment:
+    def __init__(self, comment_id: str, body: str) -> None:
+        self.id = comment_id
+        self.body = body
+        self.permalink = f"/r/Tekken/comments/dojo/_/{comment_id}/"
+
+
+class FakeReddit:
+    "Answers reddit.info() lookups, with DELETED_RATIO of the comments deleted"
+
+    def info(self, fullnames: List[str]):
+        for fullname in fullnames:
+            comment_id = fullname[3:]
+            deleted = random.Random(comment_id).random() < DELETED_RATIO
+            yield FakeComment(comment_id, "[deleted]" if deleted else "Use d/f+2")
+
+
+def generate_ticks(ticks: int, comments_per_tick: int) -> List[List[CommentRecord]]:
+    """
+    Generate ticks of synthetic comment records, each re-sending a fraction of the previous tick to
+    mimic comments which are seen twice by the stream
+    """
+
+    authors = [f"user_{i}" for i in range(200)]
+    start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    generated = []
+    previous: List[CommentRecord] = []
+    for tick in range(ticks):
+        num_duplicates = min(len(previous), int(comments_per_tick * DUPLICATE_RATIO))
+        records = random.sample(previous, num_duplicates)
+        for i in range(comments_per_tick - num_duplicates):
+            comment_id = "".join(random.choices(string.ascii_lowercase, k=7))
+            created_utc = start + timedelta(minutes=tick, seconds=i % 60)
+            root_id = "".join(random.choices(string.ascii_lowercase, k=7))
+            records.append(
+                (comment_id, created_utc, random.choice(authors), root_id, "op")
+            )
+        generated.append(records)
+        previous = records
+    return generated
+
+
+def reset_tables() -> None:
+    "Recreate the scratch Postgres tables used in place of the real Dojo tables"
+
+    drop_tables()
+    storage.PostgresStorage(
+        BENCH_TABLE_NAME,
+        BENCH_SCORES_TABLE_NAME,
+        state_table=BENCH_STATE_TABLE_NAME,
+        masters_table=BENCH_MASTERS_TABLE_NAME,
+    ).ensure_schema()
+
+
+def drop_tables() -> None:
+    with db.cursor() as cur:
+        cur.execute(
+            sql.SQL("DROP TABLE IF EXISTS {}, {}, {}, {}").format(
+                sql.Identifier(BENCH_TABLE_NAME),
+                sql.Identifier(BENCH_SCORES_TABLE_NAME),
+                sql.Identifier(BENCH_STATE_TABLE_NAME),
+                sql.Identifier(BENCH_MASTERS_TABLE_NAME),
+            )
+        )
+
+
+def ingest(
+    insert: Callable[[List[CommentRecord]], BatchResult],
+    generated: List[List[CommentRecord]],
+) -> Tuple[float, BatchResult]:
+    "Time inserting every tick with the given insert function"
+
+    inserted = duplicates = rejected = 0
+    start = time.perf_counter()
+    for records in generated:
+        result = insert(records)
+        inserted += result.inserted
+        duplicates += result.duplicates
+        rejected += result.rejected
+    elapsed = time.perf_counter() - start
+    return elapsed, BatchResult(inserted, duplicates, rejected, [])
+
+
+def bench_ingest(ticks: int, comments_per_tick: int) -> None:
+    generated = generate_ticks(ticks, comments_per_tick)
+
+    print(f"{ticks} ticks x {comments_per_tick} comments")
+    for name, batch in (("per-row", False), ("batched", True)):
+        reset_tables()
+        backend = storage.PostgresStorage(
+            BENCH_TABLE_NAME, BENCH_SCORES_TABLE_NAME, batch=batch
+        )
+        elapsed, result = ingest(backend.insert_comments, generated)
+        print(
+            f"{name:>8}: {elapsed:8.3f}s total, {1000 * elapsed / ticks:8.2f}ms/tick "
+            f"({result.inserted} inserted, {result.duplicates} duplicates, "
+            f"{result.rejected} rejected)"
+        )
+    drop_tables()
+
+
+def bench_workflows(
+    backend: storage.Storage, generated: List[List[CommentRecord]]
+) -> Dict[str, float]:
+    """
+    Run the Dojo workflows against a backend through the same code paths the bot uses
+
+    Returns: workflow -> seconds taken
+    """
+
+    storage.set_storage(backend)
+    timings: Dict[str, float] = {}
+    start_dt = generated[0][0][1].replace(day=1, hour=0, minute=0, second=0)
+    end_dt = start_dt + timedelta(days=31)
+
+    timings["ingest"], _ = ingest(backend.insert_comments, generated)
+
+    start = time.perf_counter()
+    for _ in generated:
+        dojo.tally_scores(start_dt, end_dt)
+    timings["tally (per tick)"] = (time.perf_counter() - start) / len(generated)
+
+    start = time.perf_counter()
+    dojo.check_db_health(FakeReddit(), start_dt, end_dt)
+    timings["health check"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    leaders = dojo.tally_scores(start_dt, end_dt)
+    backend.comments_by_author([author for _, author, _ in leaders], start_dt, end_dt)
+    timings["wiki comments"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    backend.delete_older_than(end_dt)
+    timings["cleanup"] = time.perf_counter() - start
+    return timings
+
+
+def bench_backends(ticks: int, comments_per_tick: int) -> None:
+    generated = generate_ticks(ticks, comments_per_tick)
+    sqlite_dir = tempfile.TemporaryDirectory()
+    backends: List[Tuple[str, Callable[[], storage.Storage]]] = [
+        ("memory", storage.MemoryStorage),
+        (
+            "sqlite",
+            lambda: storage.SQLiteStorage(os.path.join(sqlite_dir.name, "bench.db")),
+        ),
+    ]
+    if "DATABASE_URL" in os.environ:
+        reset_tables()
+        backends.append(
+            (
+                "postgres",
+                lambda: storage.PostgresStorage(
+                    BENCH_TABLE_NAME, BENCH_SCORES_TABLE_NAME
+                ),
+            )
+        )
+
+    print(f"{ticks} ticks x {comments_per_tick} comments")
+    results = {name: bench_workflows(create(), generated) for name, create in backends}
+    print(f"{'':>18}" + "".join(f"{name:>12}" for name in results))
+    for workflow in results["memory"]:
+        print(
+            f"{workflow:>18}"
+            + "".join(f"{results[name][workflow]:11.4f}s" for name in results)
+        )
+
+    if "DATABASE_URL" in os.environ:
+        drop_tables()
+    sqlite_dir.cleanup()
+
+
+def reset_state() -> None:
+    "Forget everything the bot keeps in memory between ticks, as if it was restarted"
+
+    dojo._ancestry.clear()
+    dojo._leaderboard = None
+    dojo._dojo_fullname = None
+    dojo._dojo_posts.clear()
+    redesign._written.clear()
+    redesign._widget_indexes.clear()
+    redesign._sidebars.clear()
+    twitch._logins.clear()
+
+
+def create_backend(name: str, sqlite_dir: str) -> storage.Storage:
+    "A fresh, empty backend of the given kind"
+
+    if name == "postgres":
+        reset_tables()
+        return storage.PostgresStorage(
+            BENCH_TABLE_NAME,
+            BENCH_SCORES_TABLE_NAME,
+            state_table=BENCH_STATE_TABLE_NAME,
+            masters_table=BENCH_MASTERS_TABLE_NAME,
+        )
+    if name == "sqlite":
+        path = os.path.join(sqlite_dir, f"workflows_{time.time_ns()}.db")
+        return storage.SQLiteStorage(path)
+    return storage.MemoryStorage()
+
+
+def git_commit() -> Tuple[str, bool]:
+    "Returns: (HEAD commit, True if tracked files have uncommitted changes)"
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, bool(status.strip())
+
+
+def bench_dojo(
+    backend: storage.Storage, num_comments: int, helix: fakes.FakeHelixServer
+) -> Tuple[Dict[str, float], Dict[str, int]]:
+    """
+    Run every Dojo and sidebar workflow on a generated Dojo thread of num_comments comments, the
+    way the scheduled tasks run them
+
+    Returns: (workflow -> seconds taken, API call -> times made)
+    """
+
+    reset_state()
+    storage.set_storage(backend)
+    helix.calls.clear()
+    reddit = fakes.FakeReddit(DELETED_RATIO)
+    start_dt = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end_dt = (start_dt + timedelta(days=32)).replace(day=1) - timedelta(microseconds=1)
+    submission, comments = fakes.generate_dojo_thread(reddit, num_comments, start_dt)
+    masters = [f"flair_user_{idx}" for idx in range(PREVIOUS_MASTERS)]
+    subreddit = fakes.FakeSubreddit(
+        reddit,
+        submission,
+        comments,
+        fakes.generate_flairs(NUM_FLAIRED_USERS, masters),
+        TICK_SIZE,
+    )
+    stream = subreddit.stream.comments(pause_after=0, skip_existing=True)
+    num_ticks = (num_comments + TICK_SIZE - 1) // TICK_SIZE
+    timings: Dict[str, float] = {}
+
+    start = time.perf_counter()
+    for _ in range(num_ticks):
+        dojo.ingest_new(dojo.get_tekken_dojo(subreddit), stream)
+    timings["ingest_new"] = time.perf_counter() - start
+    timings["ingest_new (per tick)"] = timings["ingest_new"] / num_ticks
+
+    start = time.perf_counter()
+    for _ in range(TALLY_REPEATS):
+        leaders = dojo.tally_scores(start_dt, end_dt)
+    timings["tally_scores"] = (time.perf_counter() - start) / TALLY_REPEATS
+
+    start = time.perf_counter()
+    comment_urls = dojo.check_db_health(reddit, start_dt, end_dt)
+    timings["check_db_health"] = time.perf_counter() - start
+
+    leaders = dojo.tally_scores(start_dt, end_dt)
+    start = time.perf_counter()
+    dojo.publish_wiki(subreddit, leaders, comment_urls, start_dt, end_dt)
+    timings["publish_wiki"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dojo.award_leader(subreddit, leaders, end_dt + timedelta(days=1))
+    timings["award_leader"] = time.perf_counter() - start
+
+    # a month later the previous Dojo Masters are known from the db instead of a flair scan
+    start = time.perf_counter()
+    dojo.award_leader(subreddit, leaders, end_dt + timedelta(days=32))
+    timings["award_leader (recorded)"] = time.perf_counter() - start
+
+    # the second round finds nothing changed, and should not write anything
+    for workflow in ("sidebar", "sidebar (unchanged)"):
+        start = time.perf_counter()
+        dojo.update_dojo_sidebar(subreddit, dojo.current_leaders(start_dt), start_dt)
+        tasks.update_livestream_widget(subreddit)
+        tasks.flush_sidebar(subreddit)
+        timings[workflow] = time.perf_counter() - start
+
+    calls = dict(reddit.calls)
+    calls.update({f"helix {endpoint}": n for endpoint, n in helix.calls.items()})
+    return timings, calls
+
+
+def load_results(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_result(results: List[dict], result: dict) -> Optional[dict]:
+    "Returns: the last recorded run of another commit on the same backend and thread size"
+
+    for previous in reversed(results):
+        if (
+            previous["commit"] != result["commit"]
+            and previous["backend"] == result["backend"]
+            and previous["comments"] == result["comments"]
+        ):
+            return previous
+    return None
+
+
+def print_result(result: dict, previous: Optional[dict]) -> None:
+    dirty = " (uncommitted changes)" if result["dirty"] else ""
+    print(
+        f"{result['comments']} comments on {result['backend']}, "
+        f"commit {result['commit']}{dirty}"
+    )
+    header = f"{'':>24}{'seconds':>12}"
+    if previous:
+        header += f"{previous['commit']:>12}{'change':>9}"
+    print(header)
+    for workflow, elapsed in result["timings"].items():
+        line = f"{workflow:>24}{elapsed:12.4f}"
+        before = previous["timings"].get(workflow) if previous else None
+        if before:
+            line += f"{before:12.4f}{100 * (elapsed - before) / before:+8.1f}%"
+        print(line)
+    print(
+        f"{'API calls':>24}  "
+        + ", ".join(f"{call} {n}" for call, n in result["calls"].items())
+    )
+    print()
+
+
+def bench_dojo_workflows(sizes: List[int], backend_name: str, path: str) -> None:
+    sqlite_dir = tempfile.TemporaryDirectory()
+    helix = fakes.FakeHelixServer().start()
+    twitch.OAUTH_URL = helix.oauth_url
+    twitch.HELIX_URL = helix.helix_url
+    os.environ.setdefault(fakes.SUBREDDIT_NAME.lower(), TWITCH_GAME_ID)
+    commit, dirty = git_commit()
+    results = load_results(path)
+    try:
+        for num_comments in sizes:
+            backend = create_backend(backend_name, sqlite_dir.name)
+            timings, calls = bench_dojo(backend, num_comments, helix)
+            result = {
+                "commit": commit,
+                "dirty": dirty,
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "backend": backend_name,
+                "comments": num_comments,
+                "timings": timings,
+                "calls": calls,
+            }
+            print_result(result, previous_result(results, result))
+            with open(path, "a") as f:
+                f.write(json.dumps(result) + "\n")
+    finally:
+        helix.stop()
+        if backend_name == "postgres":
+            drop_tables()
+        sqlite_dir.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dojo benchmarks")
+    subparsers = parser.add_subparsers(dest="command")
+    for command in ("ingest", "backends"):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument("ticks", nargs="?", type=int, default=20)
+        subparser.add_argument("comments_per_tick", nargs="?", type=int, default=200)
+    workflows = subparsers.add_parser("workflows")
+    workflows.add_argument("sizes", nargs="*", type=int, default=WORKFLOW_SIZES)
+    workflows.add_argument(
+        "--backend", choices=["sqlite", "memory", "postgres"], default="sqlite"
+    )
+    workflows.add_argument("--results", default=RESULTS_PATH)
+    args = parser.parse_args(sys.argv[1:] or ["backends"])
+
+    if args.command == "ingest":
+        bench_ingest(args.ticks, args.comments_per_tick)
+    elif args.command == "backends":
+        bench_backends(args.ticks, args.comments_per_tick)
+    elif args.command == "workflows":
+        bench_dojo_workflows(args.sizes, args.backend, args.results)
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,166 @@
+"""
+Shares the bot's Reddit API quota between its tasks by priority.
+
+Every Reddit response carries the x-ratelimit-remaining/used/reset headers of the OAuth quota
+window. A response hook on the session PRAW sends its requests through (get_session(), passed to
+praw.Reddit as requestor_kwargs={"session": ...}) keeps track of them, and counts requests against
+the task running on the current thread (see task()).
+
+Tasks have one of three priorities: moderation, then the Dojo, then cosmetic (widgets, links). Once
+the remaining quota drops below a priority's reserve, tasks of that priority are deferred until the
+window resets, leaving the rest of the quota to the more important ones -
+- should_defer() tells whether a task should skip this run
+- throttle() blocks a long-running task (e.g. the Dojo health check) between batches of requests
+"""
+
+import logging
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import requests
+
+import metrics
+
+MODERATION: str = "moderation"
+DOJO: str = "dojo"
+COSMETIC: str = "cosmetic"
+# fraction of the quota window kept in reserve for higher priorities
+RESERVES: Dict[str, float] = {MODERATION: 0.0, DOJO: 0.1, COSMETIC: 0.3}
+DEFAULT_PRIORITY: str = COSMETIC  # priority of tasks which are not in TASK_PRIORITIES
+MAX_THROTTLE_WAIT: float = (
+    600.0  # longest a throttled task waits, Reddit's window length
+)
+
+TASK_PRIORITIES: Dict[
+    str, str
+] = {}  # task name -> priority, filled in by the task runner
+
+_local = threading.local()
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+class RequestBudget:
+    "The state of the quota window, as of the last Reddit response"
+
+    def __init__(self) -> None:
+        self.remaining: Optional[float] = None
+        self.used: Optional[int] = None
+        self.reset_at = 0.0  # time.monotonic() at which the window resets
+        self.requests: Counter = Counter()  # task name -> requests made
+        self.deferred: Counter = Counter()  # task name -> runs deferred or throttled
+        self._lock = threading.Lock()
+
+    def update(self, headers, task: str) -> None:
+        metrics.inc("reddit_requests_total", task=task)
+        with self._lock:
+            self.requests[task] += 1
+            if "x-ratelimit-remaining" not in headers:
+                return
+            self.remaining = float(headers["x-ratelimit-remaining"])
+            self.used = int(headers["x-ratelimit-used"])
+            self.reset_at = time.monotonic() + int(headers["x-ratelimit-reset"])
+
+    def fraction_left(self) -> float:
+        "Returns: the fraction of the quota window left, 1.0 until a response was seen"
+
+        with self._lock:
+            if self.remaining is None or time.monotonic() >= self.reset_at:
+                return 1.0
+            total = self.remaining + self.used
+            return self.remaining / total if total else 1.0
+
+    def seconds_to_reset(self) -> float:
+        with self._lock:
+            return max(self.reset_at - time.monotonic(), 0.0)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "remaining": self.remaining,
+                "used": self.used,
+                "requests": dict(self.requests),
+                "deferred": dict(self.deferred),
+            }
+
+
+_budget = RequestBudget()
+
+
+def current_task() -> str:
+    "The name of the task running on this thread"
+
+    return getattr(_local, "task", "other")
+
+
+def priority_of(name: str) -> str:
+    return TASK_PRIORITIES.get(name, DEFAULT_PRIORITY)
+
+
+@contextmanager
+def task(name: str):
+    "Count the Reddit requests made on this thread inside the with block against task name"
+
+    previous = getattr(_local, "task", None)
+    _local.task = name
+    try:
+        yield
+    finally:
+        _local.task = previous
+
+
+def should_defer(name: str = None) -> bool:
+    "Returns: True if the quota left is within the reserve of the task's priority"
+
+    name = name or current_task()
+    reserve = RESERVES[priority_of(name)]
+    if _budget.fraction_left() >= reserve:
+        return False
+    with _budget._lock:
+        _budget.deferred[name] += 1
+    metrics.inc("reddit_deferrals_total", task=name)
+    return True
+
+
+def throttle() -> None:
+    """
+    Block the current task until the quota window resets if the quota left is within the reserve of
+    its priority. Meant to be called between batches of requests in long loops.
+    """
+
+    if should_defer():
+        wait = min(_budget.seconds_to_reset(), MAX_THROTTLE_WAIT)
+        logging.warning(
+            f"Reddit quota is low ({_budget.fraction_left():.0%} left), pausing "
+            f"{current_task()} for {wait:.0f}s"
+        )
+        time.sleep(wait)
+
+
+def _on_response(response: requests.Response, *args, **kwargs) -> None:
+    try:
+        _budget.update(response.headers, current_task())
+    except Exception:
+        logging.error(traceback.format_exc())
+
+
+def get_session() -> requests.Session:
+    "The session PRAW should send its requests through, so that they are counted"
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.hooks["response"].append(_on_response)
+            _session.hooks["response"].append(metrics.observe_response("reddit"))
+        return _session
+
+
+def stats() -> Dict[str, object]:
+    "Returns: the quota left and the requests made and runs deferred per task"
+
+    return _budget.stats()
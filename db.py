@@ -0,0 +1,241 @@
+"A process-wide pool of Postgres connections shared by the Dojo tasks."
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+import metrics
+
+MAX_CONNECTIONS: int = 4  # upper bound on connections open at the same time
+CHECKOUT_TIMEOUT: float = 30.0  # seconds to wait for a free connection before giving up
+LIVENESS_INTERVAL: float = 60.0  # ping connections idle for longer than this
+CONNECT_TIMEOUT: int = 10  # seconds to wait for a new connection to be established
+KEEPALIVES_IDLE: int = 30  # seconds of silence before TCP keepalives are sent
+KEEPALIVES_INTERVAL: int = 10  # seconds between unanswered keepalives
+KEEPALIVES_COUNT: int = 3  # unanswered keepalives after which the connection is dead
+
+_pool: Optional["ConnectionPool"] = None
+_pool_lock = threading.Lock()
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    "A cursor which records the latency of every statement it runs in the metrics"
+
+    def execute(self, query, vars=None):
+        with metrics.timer("db_query_duration_seconds"):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with metrics.timer("db_query_duration_seconds"):
+            return super().executemany(query, vars_list)
+
+
+class PoolTimeout(Exception):
+    "Raised when no connection could be checked out within CHECKOUT_TIMEOUT seconds."
+
+
+class ConnectionPool:
+    """
+    A bounded pool of psycopg2 connections.
+
+    Idle connections are reused (a pool hit) and only opened when none are idle and the pool is not
+    full (a pool miss). Callers wait once MAX_CONNECTIONS are checked out. Connections which have been
+    idle for a while are pinged before being handed out, and dead or broken connections are thrown
+    away so that the next checkout reconnects, e.g. after a database failover.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        maxsize: int = MAX_CONNECTIONS,
+        timeout: float = CHECKOUT_TIMEOUT,
+        **connect_kwargs,
+    ) -> None:
+        self.dsn = dsn
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        # (connection, time it was returned to the pool)
+        self._idle: List[Tuple[object, float]] = []
+        self._size = 0  # number of open connections, idle or checked out
+        self._cond = threading.Condition()
+        self._stats: Dict[str, float] = {
+            "hits": 0,
+            "misses": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "reconnects": 0,
+            "timeouts": 0,
+        }
+
+    def _is_alive(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < LIVENESS_INTERVAL:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn) -> None:
+        "Close a connection and free up its slot. Must be called with self._cond held."
+
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._size -= 1
+        self._cond.notify()
+
+    def getconn(self):
+        "Check out a live connection, opening a new one if there is room in the pool."
+
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        break
+                    if self._size < self.maxsize:
+                        self._size += 1
+                        break
+                    if not waited:
+                        waited = True
+                        self._stats["waits"] += 1
+                    wait_start = time.monotonic()
+                    remaining = deadline - wait_start
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available after {self.timeout}s"
+                        )
+                    self._cond.wait(remaining)
+                    self._stats["wait_seconds"] += time.monotonic() - wait_start
+                    metrics.observe(
+                        "db_pool_wait_seconds", time.monotonic() - wait_start
+                    )
+            if conn is None:
+                break
+
+            # the ping goes over the network, so it must not hold up the other threads
+            if self._is_alive(conn, idle_since):
+                with self._cond:
+                    self._stats["hits"] += 1
+                return conn
+            logging.warning("Discarding dead database connection")
+            with self._cond:
+                self._stats["reconnects"] += 1
+                self._discard(conn)
+
+        try:
+            conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["misses"] += 1
+        return conn
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        "Return a checked out connection to the pool, or close it if it is broken."
+
+        with self._cond:
+            if discard or conn.closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def closeall(self) -> None:
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+        return stats
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the process-wide pool, creating it from DATABASE_URL on first use. DATABASE_SSLMODE
+    can relax the sslmode for a local database. Connect timeouts and TCP keepalives make a dead
+    server (e.g. after a failover) surface as an error instead of hanging a task.
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                os.environ["DATABASE_URL"],
+                sslmode=os.environ.get("DATABASE_SSLMODE", "require"),
+                cursor_factory=TimedCursor,
+                connect_timeout=CONNECT_TIMEOUT,
+                keepalives=1,
+                keepalives_idle=KEEPALIVES_IDLE,
+                keepalives_interval=KEEPALIVES_INTERVAL,
+                keepalives_count=KEEPALIVES_COUNT,
+            )
+        return _pool
+
+
+@contextmanager
+def connection():
+    """
+    Check out a pooled connection for the duration of a with block. The transaction is committed if
+    the block succeeds and rolled back otherwise. Connections which break inside the block are not
+    returned to the pool.
+    """
+
+    pool = get_pool()
+    conn = pool.getconn()
+    discard = False
+    try:
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    except:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, discard=discard)
+
+
+@contextmanager
+def cursor():
+    "A cursor on a pooled connection, committed when the with block exits cleanly."
+
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def pool_stats() -> Dict[str, float]:
+    "Hit, miss, wait and reconnect counters of the process-wide pool"
+
+    return get_pool().stats()
@@ -2,31 +2,41 @@
 
 import calendar
 import logging
-import os
+import threading
 import time
 import traceback
-from datetime import datetime
-from typing import Dict, List, Tuple
-
-import psycopg2
-from psycopg2 import sql
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
 
+import budget
+import cache
+import filters
 import redesign
+import storage
+import streams
+from leaderboard import Leaderboard
+from storage import CommentRecord, MasterRecord, month_of
 
-TABLE_NAME: str = (
-    "dojo_comments"  # the name of the table where Tekken Dojo comments are stored
-)
 LEADERBOARD_SIZE: int = 5  # the top-k commenters will be displayed
 WEEK_BUFFER: int = 20  # delete comments from the database older than these many weeks
 DOJO_MASTER_FLAIR_ID: str = "cc570168-4176-11eb-abb3-0e92e4d477f5"
-
-
-def connect_to_db():
-    "Connect to database and return the connection object."
-
-    DATABASE_URL = os.environ["DATABASE_URL"]
-    conn = psycopg2.connect(DATABASE_URL, sslmode="require")
-    return conn
+INFO_BATCH_SIZE: int = 100  # comments looked up per request when verifying the db
+VERIFY_WORKERS: int = 4  # concurrent lookups when verifying the db
+ANCESTRY_CACHE_SIZE: int = 20000  # comments whose root comment is kept in memory
+FLAIR_UPDATE_BATCH: int = 100  # flairs changed per request, the most Reddit accepts
+DOJO_POST_TTL: float = 5 * 60  # seconds before the current Dojo post is looked up again
+
+_ancestry = cache.LRUCache(ANCESTRY_CACHE_SIZE)  # comment id -> (root_id, root_author)
+# scores of the month being ranked every tick
+_leaderboard: Optional[Leaderboard] = None
+# held across every write of the scores table and the matching leaderboard update, and across
+# every read of the scores table into the leaderboard, so that no rows are counted twice or lost
+_leaderboard_lock = threading.RLock()
+_unhelpful: Optional[filters.PhraseMatcher] = None  # loaded on first use
+_dojo_fullname: Optional[str] = None  # fullname of the Dojo post last ingested
+# subreddit name -> fullname of its current Dojo post
+_dojo_posts = cache.TTLCache(16, DOJO_POST_TTL)
 
 
 def get_tekken_dojo(subreddit):
@@ -51,36 +61,82 @@ def is_unhelpful(comment) -> bool:
     spam/low-effort but should still not be counted. This function checks for these sort of comments
     """
 
-    is_unhelpful = False
     if not comment:
         logging.error("Comment object was None")
         return False
     if not comment.body:
         logging.warning(f"Comment {comment.id} was deleted")
         return False
-    filter = [
-        "you're welcome",
-        "no problem",
-    ]
-    for text in filter:
-        if text.lower() in comment.body.lower():
-            is_unhelpful = True
+    return get_filter().matches(comment.body)
 
-    return is_unhelpful
 
+def get_filter() -> filters.PhraseMatcher:
+    "The matcher of unhelpful comments, compiled from the filter config on first use"
 
-def ingest_new(submission, stream) -> int:
+    global _unhelpful
+    if _unhelpful is None:
+        _unhelpful = filters.load_matcher()
+    return _unhelpful
+
+
+def _author_name(comment) -> Optional[str]:
+    "Name of the comment's author, or None if the comment (or the account) was deleted"
+
+    return comment.author.name if comment.author else None
+
+
+def _prefetch_roots(comments) -> None:
     """
-    Ingest all new comments made on the submmission into the database.
-    Assumes table TABLE_NAME is already created
+    Warm the ancestry cache with the stored roots of every parent comment which is not cached yet,
+    using a single query for the whole tick.
+    """
+
+    parent_ids = {
+        comment.parent_id[3:]
+        for comment in comments
+        if not comment.is_root and comment.parent_id[3:] not in _ancestry
+    }
+    if not parent_ids:
+        return
+    roots = storage.get_storage().lookup_roots(parent_ids)
+    for comment_id, root in roots.items():
+        _ancestry.put(comment_id, root)
+    logging.debug(f"Prefetched {len(roots)} of {len(parent_ids)} parent roots")
+
+
+def resolve_root(comment) -> Tuple[str, Optional[str]]:
     """
+    Returns: (root_id, root_author) of the top-level comment the comment is replying to
 
-    logging.debug("Connecting to db...")
-    conn = connect_to_db()
-    logging.debug("Connected to db!")
-    cur = conn.cursor()
+    Walks up the reply chain only until it reaches a comment whose root is already known, so a new
+    reply to a cached comment costs no API calls. Every comment on the walked path is cached.
+    """
 
-    records = 0  # to count total number of comments inserted into the db
+    path = []
+    ancestor = comment
+    while True:
+        root = _ancestry.get(ancestor.id)
+        if root is not None:
+            break
+        path.append(ancestor.id)
+        if ancestor.is_root:
+            root = (ancestor.id, _author_name(ancestor))
+            break
+        root = _ancestry.get(ancestor.parent_id[3:])
+        if root is not None:
+            break
+        logging.debug(f"Ancestry cache miss for {ancestor.parent_id}, fetching parent")
+        ancestor = ancestor.parent()
+    for comment_id in path:
+        _ancestry.put(comment_id, root)
+    return root
+
+
+def collect_records(submission, stream) -> List[CommentRecord]:
+    """
+    Drain the comment stream and return (id, created_utc, author, root_id, root_author) records for
+    every new comment on the submission which should count towards a user's Dojo Points.
+    """
 
     new_comments = []
     try:
@@ -94,121 +150,105 @@ def ingest_new(submission, stream) -> int:
     except:
         logging.error(traceback.format_exc())
 
-    for (
-        comment
-    ) in (
-        new_comments
+    _prefetch_roots(new_comments)
+
+    # Filter comments whose content is not helpful, checking the whole tick at once
+    unhelpful = get_filter().classify(comment.body for comment in new_comments)
+
+    records = []
+    for comment, skip in zip(
+        new_comments, unhelpful
     ):  # ref.: https://praw.readthedocs.io/en/latest/tutorials/comments.html
 
         # Find root comment of this comment
-        ancestor = comment
-        while not ancestor.is_root:
-            ancestor = ancestor.parent()
-        if ancestor.author == comment.author:
+        root_id, root_author = resolve_root(comment)
+        author = _author_name(comment)
+        if (root_author or "").lower() == (author or "").lower():
             continue
 
         # Account for comment being deleted, which means comment.author is None
-        if comment.author:
-            author = comment.author.name
-        else:
+        if not author:
             author = "[deleted]"
 
-        # TODO: Filter comment if its content is not helpful
-        if is_unhelpful(comment):
+        if skip:
+            logging.debug(f"Comment {comment.id} is not helpful")
             continue
 
-        record = (comment.id, datetime.fromtimestamp(comment.created_utc), author)
-        logging.debug("Comment record: ({}, {}, {})".format(*record))
+        record = (
+            comment.id,
+            datetime.fromtimestamp(comment.created_utc),
+            author,
+            root_id,
+            root_author,
+        )
+        logging.debug("Comment record: ({}, {}, {}, {}, {})".format(*record))
+        records.append(record)
+    logging.debug(
+        f"Ancestry cache: {len(_ancestry)} entries, {_ancestry.hits} hits, {_ancestry.misses} misses"
+    )
+    return records
+
+
+def current_dojo_fullname(subreddit) -> Optional[str]:
+    """
+    Returns: the fullname of the subreddit's current Dojo post, looked up at most every
+    DOJO_POST_TTL seconds, or of the Dojo post last ingested if the lookup fails
+    """
+
+    name = subreddit.display_name.lower()
+    fullname = _dojo_posts.get(name)
+    if fullname is None:
         try:
-            cur.execute(
-                sql.SQL(
-                    """
-            INSERT INTO {} (id, created_utc, author) 
-            VALUES (%s, %s, %s)
-            ON CONFLICT DO NOTHING
-            """
-                ).format(sql.Identifier(TABLE_NAME)),
-                record,
-            )
-            if cur.rowcount == 0:
-                logging.debug("Comment already exists in db!")
-            else:
-                logging.debug("Inserted comment into db")
-            records += cur.rowcount
-        except:
+            budget.throttle()
+            fullname = get_tekken_dojo(subreddit).fullname
+        except Exception:
             logging.error(traceback.format_exc())
-            conn.rollback()
-            continue
+            return _dojo_fullname
+        _dojo_posts.put(name, fullname)
+    return fullname
 
-    conn.commit()
-    cur.close()
-    logging.debug("Closing connection...")
-    conn.close()
-    return records
+
+def is_dojo_comment(comment) -> bool:
+    """
+    Returns True if a comment was made on the current Tekken Dojo post, or if the Dojo post is not
+    known. Used to only queue the Dojo's comments for ingestion.
+    """
+
+    fullname = current_dojo_fullname(comment.subreddit)
+    return fullname is None or comment.link_id == fullname
+
+
+def ingest_new(submission, stream) -> int:
+    """
+    Ingest all new comments made on the submmission into the database.
+    Assumes the Dojo tables are already created. The drained comments are committed on the stream
+    once they are stored, and are handed out again on the next tick if storing them failed.
+    """
+
+    global _dojo_fullname
+    _dojo_fullname = submission.fullname
+    records = collect_records(submission, stream)
+    with _leaderboard_lock:
+        result = storage.get_storage().insert_comments(records)
+        update_leaderboard(result.rows, 1)
+    # only now can the stream checkpoint move past the drained comments
+    streams.commit(stream)
+    return result.inserted
 
 
 def tally_scores(
     start_timestamp: datetime, end_timestamp: datetime
 ) -> List[Tuple[int, str, int]]:
     """
-    Go through database to produce count of final scores + comment_ids for comments lying in range
-    [start_timestamp, end_timestamp]
-    """
-
-    logging.debug("Connecting to db...")
-    conn = connect_to_db()
-    logging.debug("Connected to db!")
-    cur = conn.cursor()
-
-    query = sql.SQL(
-        """
-    WITH monthly_leaderboard AS (
-        SELECT author, COUNT(*) AS c
-        FROM {}
-        WHERE 
-        created_utc BETWEEN %s AND %s
-        AND
-        author != '[deleted]'
-        GROUP BY author
-        ORDER BY COUNT(*) DESC
-        LIMIT %s
-    ),
-    last_count AS (
-        SELECT monthly_leaderboard.c AS c
-        FROM monthly_leaderboard
-        OFFSET %s
-    ),
-    trailers AS (
-        SELECT author, COUNT(*) AS c
-        FROM {}
-        WHERE created_utc BETWEEN %s AND %s
-        GROUP BY author
-        HAVING COUNT(*) = (SELECT last_count.c FROM last_count)
-    )
-    SELECT * FROM monthly_leaderboard
-    UNION
-    SELECT * FROM trailers
-    ORDER BY c DESC
-    """
-    ).format(sql.Identifier(TABLE_NAME), sql.Identifier(TABLE_NAME))
-    params = (
-        start_timestamp,
-        end_timestamp,
-        LEADERBOARD_SIZE,
-        LEADERBOARD_SIZE - 1,
-        start_timestamp,
-        end_timestamp,
-    )
+    Read the leaderboard for the month of start_timestamp from the monthly scores table. Everyone
+    tied with the LEADERBOARD_SIZE-th score is included.
 
-    logging.debug(
-        cur.mogrify(
-            query,
-            params,
-        )
-    )
-    cur.execute(
-        query,
-        params,
+    Scores are kept per calendar month, so [start_timestamp, end_timestamp] is expected to span
+    exactly one month.
+    """
+
+    top_scores = storage.get_storage().top_scores(
+        month_of(start_timestamp), LEADERBOARD_SIZE
     )
 
     leaders: List[
@@ -216,7 +256,7 @@ def tally_scores(
     ] = []  # stores (rank, username, score) for each user in leaderboard
     last_score: int = -1
     rank: int = 0
-    while record := cur.fetchone():
+    for record in top_scores:
         curr_score = record[1]
         if last_score != curr_score:
             rank += 1
@@ -225,54 +265,150 @@ def tally_scores(
         logging.debug(f"Obtained leaderboard entry {leader_record}")
         leaders.append(leader_record)
 
-    cur.close()
-    logging.debug("Closing connection...")
-    conn.close()
     logging.debug(f"Leaderboard for {start_timestamp.month}: {leaders}")
     logging.info(f"Succesfully generated leaderboard for {start_timestamp.month}")
     return leaders
 
 
+def get_leaderboard(month: date) -> Leaderboard:
+    """
+    Returns the in-memory leaderboard for the month, hydrating it from the scores table the first
+    time it is asked for (at startup, and again whenever the month rolls over).
+    """
+
+    global _leaderboard
+    with _leaderboard_lock:
+        if _leaderboard is None or _leaderboard.month != month:
+            _leaderboard = Leaderboard(month, storage.get_storage().month_scores(month))
+            logging.info(f"Loaded {len(_leaderboard)} scores for {month} from db")
+        return _leaderboard
+
+
+def update_leaderboard(rows: List[Tuple[datetime, str]], sign: int) -> None:
+    """
+    Apply committed inserts (sign = 1) or deletes (sign = -1) of (created_utc, author) rows to the
+    in-memory leaderboard. Rows from other months are ignored. Must be called with
+    _leaderboard_lock held since before the rows were written.
+    """
+
+    board = _leaderboard
+    if board is None:  # not hydrated yet, will be read from the db with these rows in
+        return
+    for created_utc, author in rows:
+        if month_of(created_utc) == board.month:
+            board.add(author, sign)
+
+
+def current_leaders(dt: datetime) -> List[Tuple[int, str, int]]:
+    """
+    Returns the (rank, username, score) leaderboard for the month of dt from memory, without
+    querying the database.
+    """
+
+    leaders = get_leaderboard(month_of(dt)).top(LEADERBOARD_SIZE)
+    logging.debug(f"Leaderboard for {dt.month}: {leaders}")
+    return leaders
+
+
+def reconcile_leaderboard(dt: datetime) -> int:
+    """
+    Compare the in-memory leaderboard for the month of dt with the scores table, and reload it from
+    the table if they have drifted apart.
+
+    Returns: the number of authors whose score had drifted
+    """
+
+    month = month_of(dt)
+    with _leaderboard_lock:
+        board = get_leaderboard(month)
+        scores = storage.get_storage().month_scores(month)
+        drift = board.drift(scores)
+        if drift:
+            logging.warning(
+                f"In-memory leaderboard for {month} drifted for {len(drift)} authors: {drift}"
+            )
+            board.load(scores)
+        else:
+            logging.debug(f"In-memory leaderboard for {month} matches db")
+    return len(drift)
+
+
+def _is_removed(comment) -> bool:
+    "Returns True if a comment fetched from Reddit has been deleted by its author or removed"
+
+    return not comment.body or comment.body in ("[deleted]", "[removed]")
+
+
+def _fetch_comments(reddit, comment_ids: List[str], task: str) -> Dict[str, object]:
+    """
+    Look up a batch of at most INFO_BATCH_SIZE comments with a single request, counted against the
+    given task and held back while the Reddit quota is low
+    """
+
+    with budget.task(task):
+        budget.throttle()
+        fullnames = [f"t1_{comment_id}" for comment_id in comment_ids]
+        return {comment.id: comment for comment in reddit.info(fullnames=fullnames)}
+
+
 def check_db_health(reddit, start_timestamp, end_timestamp) -> Dict[str, str]:
     """
     Ensures that every comment in the database in the range [start_timestamp, end_timestamp] still
     exists i.e. has not been deleted.
 
-    Goes through every comment in the database in the given range and checks if the comment body is
-    present. If not, it is deleted.
-    """
+    Looks the comments up INFO_BATCH_SIZE at a time on a pool of VERIFY_WORKERS threads, and deletes
+    every comment whose body is gone (or which Reddit no longer returns) with a single statement.
+    Comments in a batch whose lookup failed are kept.
 
-    logging.debug("Connecting to db...")
-    conn = connect_to_db()
-    logging.debug("Connected to db!")
-    cur = conn.cursor()
-    cur.execute(
-        sql.SQL(
-            """
-    SELECT id from {}
-    WHERE created_utc BETWEEN %s AND %s
+    Returns: comment id -> permalink for every comment which still exists
     """
-        ).format(sql.Identifier(TABLE_NAME)),
-        (start_timestamp, end_timestamp),
-    )
+
+    comment_ids = storage.get_storage().comment_ids(start_timestamp, end_timestamp)
+    logging.info(f"Verifying {len(comment_ids)} comments")
 
     url_list: Dict[str, str] = {}
-    while record := cur.fetchone():
-        logging.debug(f"Fetched record {record}")
-        comment = reddit.comment(record[0])
-        if not comment.body:
-            cur.execute(
-                sql.SQL(
-                    """
-            DELETE FROM {}
-            WHERE id = %s
-            """
-                ).format(sql.Identifier(TABLE_NAME)),
-                (comment.id),
+    missing: List[str] = []
+    batches = [
+        comment_ids[idx : idx + INFO_BATCH_SIZE]
+        for idx in range(0, len(comment_ids), INFO_BATCH_SIZE)
+    ]
+    start = time.perf_counter()
+    verified = 0
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        futures = {
+            executor.submit(
+                _fetch_comments, reddit, batch, budget.current_task()
+            ): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                comments = future.result()
+            except Exception:
+                logging.error(f"Could not verify batch starting at {batch[0]}")
+                logging.error(traceback.format_exc())
+                continue
+            for comment_id in batch:
+                comment = comments.get(comment_id)
+                if comment is None or _is_removed(comment):
+                    logging.debug(f"Comment {comment_id} no longer exists")
+                    missing.append(comment_id)
+                else:
+                    url_list[comment_id] = comment.permalink
+            verified += len(batch)
+            elapsed = time.perf_counter() - start
+            logging.info(
+                f"Verified {verified}/{len(comment_ids)} comments "
+                f"({verified / elapsed:.1f} comments/s)"
             )
-            logging.info(f"Deleted record for comment {comment.id} from db")
-        else:
-            url_list[comment.id] = comment.permalink
+
+    deleted: List[Tuple[datetime, str]] = []
+    with _leaderboard_lock:
+        if missing:
+            deleted = storage.get_storage().delete_comments(missing)
+            logging.info(f"Deleted records for {len(deleted)} comments from db")
+        update_leaderboard(deleted, -1)
     return url_list
 
 
@@ -309,12 +445,59 @@ def update_dojo_sidebar(subreddit, leaders, dt) -> None:
     )
 
 
+def _scan_masters(subreddit) -> List[Tuple[str, str]]:
+    """
+    Find the Dojo Masters by listing every flair of the subreddit. Only needed while no Dojo Master
+    has been recorded in the db yet.
+
+    Returns: (username, flair text to restore) of every user with the dojo-master css class
+    """
+
+    masters = []
+    for flair in subreddit.flair(limit=None):
+        if flair["flair_css_class"] == "dojo-master":
+            previous_flair = flair["flair_text"].rsplit("|")[0]
+            if previous_flair == flair["flair_text"]:  # prev flair could have been None
+                previous_flair = ""
+            masters.append((flair["user"].name, previous_flair))
+    return masters
+
+
+def _update_flairs(subreddit, flairs: List[Dict[str, str]]) -> List[str]:
+    """
+    Change the flairs of many users with one request per FLAIR_UPDATE_BATCH users
+
+    Returns: the users whose flair was changed
+    """
+
+    updated = []
+    for idx in range(0, len(flairs), FLAIR_UPDATE_BATCH):
+        batch = flairs[idx : idx + FLAIR_UPDATE_BATCH]
+        budget.throttle()
+        try:
+            results = subreddit.flair.update(batch)
+        except Exception:
+            logging.error(traceback.format_exc())
+            continue
+        # Reddit answers every line of the batch in order
+        for flair, result in zip(batch, results or []):
+            if result.get("ok"):
+                updated.append(str(flair["user"]))
+            else:
+                logging.error(f"Could not update flair of {flair['user']}: {result}")
+    return updated
+
+
 def award_leader(subreddit, leaders, dt) -> None:
     """
     Awards user(s) with Dojo Master flair and removes flair from previous Dojo Master.
 
     Flair is appended to end of users' existing flair with '| Dojo Master (Mon)'.
     Previous Dojo Masters' Flair is changed to Mokujin with their original flair text restored.
+
+    The Dojo Masters and their original flair text are recorded in the db, so only the previous
+    Dojo Masters are looked at when revoking their flair, with bulk flair updates. The subreddit's
+    flairs are only scanned if no Dojo Master was ever recorded.
     """
 
     # Generate flair text to be appended to leader flair
@@ -324,21 +507,32 @@ def award_leader(subreddit, leaders, dt) -> None:
     logging.debug(f"Dojo flair text generated is {dojo_flair_text}")
 
     # Remove dojo flair from previous leader
-    for flair in subreddit.flair(limit=None):
-        if flair["flair_css_class"] == "dojo-master":
-            previous_flair = flair["flair_text"].rsplit("|")[0]
-            if previous_flair == flair["flair_text"]:  # prev flair could have been None
-                previous_flair = ""
-            logging.info(
-                f'Setting flair of previous leader {flair["user"].name} to {previous_flair}'
-            )
-            subreddit.flair.set(
-                flair["user"].name,
-                text=previous_flair,
-                css_class="mokujin",
-            )
+    backend = storage.get_storage()
+    previous: Dict[str, str] = {}  # username -> flair text to restore
+    for username, _, original_flair_text in backend.masters():
+        # the earliest award of a user who was never revoked has their real original flair
+        previous.setdefault(username, original_flair_text or "")
+    if not previous and not backend.masters(current_only=False):
+        logging.warning("No Dojo Masters recorded, scanning every flair for them")
+        previous = dict(_scan_masters(subreddit))
+    for username, previous_flair in previous.items():
+        logging.info(f"Setting flair of previous leader {username} to {previous_flair}")
+    revoked = _update_flairs(
+        subreddit,
+        [
+            {
+                "user": username,
+                "flair_text": previous_flair,
+                "flair_css_class": "mokujin",
+            }
+            for username, previous_flair in previous.items()
+        ],
+    )
+    # the others keep counting as Dojo Masters, so that their flair is restored next time
+    backend.revoke_masters(revoked)
 
-    # Set flair of leader(s)
+    # Set flair of leader(s). The Dojo Master flair template (its colours) can only be applied one
+    # user at a time, and there is usually only one leader.
     for rank, user, points in leaders:
         if rank == 1:
             original_flair_text = next(subreddit.flair(user)).get("flair_text", "")
@@ -349,9 +543,13 @@ def award_leader(subreddit, leaders, dt) -> None:
                 new_flair_text = f"{original_flair_text.rstrip()} | {dojo_flair_text}"
             else:
                 new_flair_text = f"{dojo_flair_text}"
+            budget.throttle()
             subreddit.flair.set(
                 user, text=new_flair_text, flair_template_id=DOJO_MASTER_FLAIR_ID
             )
+            # recorded right away, so that the flair is revoked even if a later award fails
+            master: MasterRecord = (user, month_of(dt), original_flair_text)
+            backend.record_masters([master])
             logging.info(f"Set flair of {user} as '{new_flair_text}'")
 
 
@@ -368,39 +566,26 @@ def publish_wiki(subreddit, leaders, comment_urls, start_dt, end_dt) -> None:
     month = calendar.month_name[start_dt.month][:3]
     text = f"# Leaderboard for ({month} {year})\n\n"
 
-    # For each author, get comments made by them in the given timeframe
-    logging.debug("Connecting to db...")
-    conn = connect_to_db()
-    logging.debug("Connected to db!")
-    cur = conn.cursor()
-    url_list = []
-    for _, author, score in leaders:
-        curr_url_list = []
-        cur.execute(
-            sql.SQL(
-                """
-        SELECT id from {}
-        WHERE author = %s
-        AND
-        created_utc BETWEEN %s AND %s
-        """
-            ).format(sql.Identifier(TABLE_NAME)),
-            (author, start_dt, end_dt),
-        )
-        if cur.rowcount != score:
-            logging.error(
-                f"# of rows retrieved for {author} does not match their score ({score})!"
-            )
-        while record := cur.fetchone():
-            logging.debug(f"Retrieved record {record}")
-            permalink = comment_urls[record[0]]
-            curr_url_list.append(permalink)
-        url_list.append(curr_url_list)
+    # Get the comments made by every author on the leaderboard in the given timeframe at once
+    comment_ids = storage.get_storage().comments_by_author(
+        [author for _, author, _ in leaders], start_dt, end_dt
+    )
 
     # Create table
     table = "Rank | User | Score | Comments\n"
     table += ":-: | :-: | :-: | :--\n"
-    for (rank, author, score), author_url_list in zip(leaders, url_list):
+    for rank, author, score in leaders:
+        author_comment_ids = comment_ids.get(author, [])
+        if len(author_comment_ids) != score:
+            logging.error(
+                f"# of rows retrieved for {author} ({len(author_comment_ids)}) does not match their score ({score})!"
+            )
+        author_url_list = []
+        for comment_id in author_comment_ids:
+            if comment_id not in comment_urls:
+                logging.warning(f"No permalink found for comment {comment_id}")
+                continue
+            author_url_list.append(comment_urls[comment_id])
         url_str = ", ".join(
             f"[{idx + 1}]({url})" for idx, url in enumerate(author_url_list)
         )
@@ -425,3 +610,30 @@ def publish_wiki(subreddit, leaders, comment_urls, start_dt, end_dt) -> None:
         logging.info("Successfully updated wiki")
     except:
         logging.error(traceback.format_exc())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Dojo database maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser(
+        "rebuild-scores",
+        help=f"reconstruct {storage.SCORES_TABLE_NAME} from {storage.TABLE_NAME}",
+    )
+    rebuild.add_argument(
+        "month", nargs="?", help="YYYY-MM of the month to rebuild (default: all)"
+    )
+    subparsers.add_parser(
+        "create-schema",
+        help="create the Dojo tables and upcoming partitions, migrating an unpartitioned table",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "rebuild-scores":
+        month = datetime.strptime(args.month, "%Y-%m").date() if args.month else None
+        rebuilt = storage.get_storage().rebuild_scores(month)
+        logging.info(f"Rebuilt {rebuilt} scores for {month or 'all months'}")
+    elif args.command == "create-schema":
+        storage.get_storage().ensure_schema()
@@ -0,0 +1,215 @@
+"""
+Runs the bot's scheduled tasks on a bounded thread pool, so that one slow task (e.g. a Twitch call
+which hangs, or the monthly Dojo health check) cannot delay the others.
+
+Every task is identified by name. A task never runs twice at the same time: if it is still running
+when it is due again, the new run is either skipped or coalesced into a single run started as soon
+as the current one finishes. Runs which take longer than the task's timeout are reported (a thread
+can not be killed, so the run is left to finish). Runs are deferred while the Reddit quota left is
+within the reserve of the task's priority (see budget.py).
+"""
+
+import logging
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Set
+
+import budget
+import metrics
+
+MAX_WORKERS: int = 4  # tasks running at the same time
+DEFAULT_TIMEOUT: float = (
+    300.0  # seconds a run may take before it is reported as overrunning
+)
+
+SKIP: str = "skip"  # drop runs which are due while the task is still running
+COALESCE: str = (
+    "coalesce"  # rerun once after the current run, however many runs were due
+)
+
+
+class _TaskState:
+    def __init__(self) -> None:
+        self.running = False
+        self.waiting = False  # a run is waiting out its jitter before it is started
+        self.pending: Optional[Callable[[], None]] = None  # coalesced run to start next
+        self.started = 0.0
+        self.timeout = DEFAULT_TIMEOUT
+        self.overrun_reported = False
+        self.stats: Dict[str, float] = {
+            "runs": 0,
+            "failures": 0,
+            "skipped": 0,
+            "coalesced": 0,
+            "overruns": 0,
+            "deferred": 0,
+            "last_seconds": 0.0,
+            "max_seconds": 0.0,
+        }
+
+
+class TaskExecutor:
+    """
+    Submits named tasks to a thread pool of max_workers threads, at most one run of each task at a
+    time. submit() returns immediately, so it can be used as the job of a schedule entry -
+
+        schedule.every(30).seconds.do(executor.submit, "livestream", update_livestream_widget)
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS) -> None:
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="task"
+        )
+        self._tasks: Dict[str, _TaskState] = {}
+        self._timers: Set[threading.Timer] = set()  # runs waiting out their jitter
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        name: str,
+        func: Callable,
+        *args,
+        timeout: float = DEFAULT_TIMEOUT,
+        jitter: float = 0.0,
+        policy: str = SKIP,
+        **kwargs,
+    ) -> bool:
+        """
+        Start a run of the task unless it is already running, in which case policy decides whether
+        the run is skipped or coalesced. With a jitter, the run is started after a random 0 to jitter
+        seconds instead, to spread out tasks which are scheduled at the same moment. It waits on a
+        timer rather than in the pool, so that it does not hold a worker, and runs which are due in
+        the meantime are merged into it.
+
+        Returns: True if a run was started, or will be once its jitter has passed
+        """
+
+        def run() -> None:
+            self._run(name, func, timeout, args, kwargs)
+
+        if not jitter:
+            return self._start(name, run, policy)
+        with self._lock:
+            state = self._tasks.setdefault(name, _TaskState())
+            if state.waiting:
+                logging.debug(
+                    f"Task {name} is already about to start, merging this run"
+                )
+                return False
+            state.waiting = True
+            timer = threading.Timer(
+                random.uniform(0, jitter), self._start_waiting, args=(name, run, policy)
+            )
+            timer.daemon = True
+            self._timers.add(timer)
+        timer.start()
+        return True
+
+    def _start_waiting(self, name: str, run: Callable[[], None], policy: str) -> None:
+        with self._lock:
+            self._timers.discard(threading.current_thread())
+            self._tasks[name].waiting = False
+        try:
+            self._start(name, run, policy)
+        except RuntimeError:
+            # the executor was shut down while the run was waiting
+            logging.debug(f"Dropped the waiting run of task {name}")
+
+    def _start(self, name: str, run: Callable[[], None], policy: str) -> bool:
+        with self._lock:
+            state = self._tasks.setdefault(name, _TaskState())
+            if state.running:
+                if policy == COALESCE:
+                    state.pending = run
+                    state.stats["coalesced"] += 1
+                    logging.debug(f"Task {name} is still running, coalescing this run")
+                else:
+                    state.stats["skipped"] += 1
+                    metrics.inc("task_skipped_total", task=name)
+                    logging.debug(f"Task {name} is still running, skipping this run")
+                return False
+            state.running = True
+            state.started = time.monotonic()
+            state.overrun_reported = False
+        self._pool.submit(run)
+        return True
+
+    def _run(
+        self, name: str, func: Callable, timeout: float, args: tuple, kwargs: dict
+    ) -> None:
+        state = self._tasks[name]
+        with self._lock:
+            state.started = time.monotonic()
+            state.timeout = timeout
+        outcome = "failed"
+        try:
+            with budget.task(name):
+                if budget.should_defer(name):
+                    # leave the rest of the Reddit quota to more important tasks
+                    state.stats["deferred"] += 1
+                    outcome = "deferred"
+                    logging.info(f"Reddit quota is low, deferring task {name}")
+                else:
+                    func(*args, **kwargs)
+                    outcome = "ok"
+        except:
+            # tasks handle their own errors, this only catches what they let through
+            state.stats["failures"] += 1
+            outcome = "failed"
+            logging.error(f"Task {name} failed: {traceback.format_exc()}")
+        elapsed = time.monotonic() - state.started
+        metrics.inc("task_runs_total", task=name, outcome=outcome)
+        metrics.observe("task_duration_seconds", elapsed, task=name)
+
+        with self._lock:
+            if elapsed > timeout and not state.overrun_reported:
+                state.stats["overruns"] += 1
+                metrics.inc("task_overruns_total", task=name)
+                logging.warning(
+                    f"Task {name} took {elapsed:.1f}s, over its {timeout}s timeout"
+                )
+            state.stats["runs"] += 1
+            state.stats["last_seconds"] = elapsed
+            state.stats["max_seconds"] = max(state.stats["max_seconds"], elapsed)
+            pending, state.pending = state.pending, None
+            if pending is None:
+                state.running = False
+                return
+            state.started = time.monotonic()
+            state.overrun_reported = False
+        self._pool.submit(pending)
+
+    def check_timeouts(self) -> None:
+        "Report every run which has been going for longer than its task's timeout"
+
+        now = time.monotonic()
+        with self._lock:
+            for name, state in self._tasks.items():
+                if (
+                    state.running
+                    and not state.overrun_reported
+                    and now - state.started > state.timeout
+                ):
+                    state.overrun_reported = True
+                    state.stats["overruns"] += 1
+                    metrics.inc("task_overruns_total", task=name)
+                    logging.error(
+                        f"Task {name} has been running for {now - state.started:.0f}s, "
+                        f"over its {state.timeout}s timeout"
+                    )
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        "Returns: task name -> run, failure, skip, coalesce and overrun counters"
+
+        with self._lock:
+            return {name: dict(state.stats) for name, state in self._tasks.items()}
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            timers, self._timers = self._timers, set()
+        for timer in timers:
+            timer.cancel()
+        self._pool.shutdown(wait=wait)
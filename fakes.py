@@ -0,0 +1,603 @@
+"""
+Offline stand-ins for the Reddit and Twitch APIs, used by bench.py to run the bot's workflows
+without any network access.
+
+The fake PRAW objects implement only what the bot reads and calls, and count every call which would
+have been an API request in FakeReddit.calls, e.g. calls["parent"] for each comment.parent() which
+walked up a reply chain. FakeHelixServer serves the Helix endpoints used by twitch.py from a local
+HTTP server, so that the Twitch code path (session, token, requests) runs unchanged.
+"""
+
+import json
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import praw
+import prawcore
+import requests
+
+SUBREDDIT_NAME: str = "Tekken"
+DELETED_RATIO: float = 0.05  # fraction of comments reddit.info() reports as deleted
+TOP_LEVEL_RATIO: float = 0.25  # fraction of comments which are questions
+CONTINUE_CHAIN_RATIO: float = 0.6  # replies which continue the newest conversation
+OP_REPLY_RATIO: float = 0.15  # replies made by the author of the question
+DELETED_AUTHOR_RATIO: float = 0.01  # comments whose account has been deleted
+UNHELPFUL_RATIO: float = 0.03  # replies like 'Thanks!', which earn no points
+RECENT_WINDOW: int = 1000  # replies go to one of this many most recent comments
+MAX_DEPTH: int = 200  # deepest reply in a generated thread
+FLAIR_PAGE_SIZE: int = 1000  # flairs per request when listing every flair
+FLAIR_UPDATE_BATCH: int = 100  # flairs per request of subreddit.flair.update()
+
+QUESTIONS = [
+    "How do I punish {move} on block?",
+    "What's the best way to deal with {move} spam?",
+    "Is {move} a safe string?",
+    "Any tips for learning to duck {move}?",
+    "Which side should I sidestep {move} to?",
+]
+ANSWERS = [
+    "{move} is -12 on block, so you can punish it with your fastest d/f+1 or standing 1,2.",
+    "Sidestep to the left, the follow-up of {move} does not track that way.",
+    "Duck the second hit of {move} and launch with your while-standing punisher.",
+    "Block the first hit, then interrupt with a jab before the mix-up of {move}.",
+    "Lab it: record {move} in practice mode and try every punisher you have.",
+    "It's a natural combo on counter hit only, so just block and punish {move}.",
+]
+UNHELPFUL = ["Thanks!", "No problem!", "You're welcome", "thank you so much", "np"]
+MOVES = ["d/f+2", "b+1+2", "f,F+2", "ws4", "u/f+4", "df1,2", "b4", "hellsweep"]
+SIDEBAR_TEXT = """# Livestreams
+
+Twitch | 👁 | Streamer
+:- | :- | :-
+
+****
+
+# Dojo Leaderboard (Jan '21)
+
+Rank | User | Points
+:-: | :- | :-:
+
+****
+
+# Upcoming Events
+
+Name | Starts (UTC) | Location
+:-- | :-: | :--
+
+****
+
+# Useful Stuff
+
+* [Tekken Dojo](https://www.reddit.com/r/Tekken/comments/dojo/)
+"""
+
+
+def base36(number: int) -> str:
+    "A Reddit style id, e.g. 'k0a1b'"
+
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, digit = divmod(number, 36)
+        encoded = digits[digit] + encoded
+        if number == 0:
+            return encoded
+
+
+class FakeRedditor:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeSubmission:
+    def __init__(self, reddit: "FakeReddit", submission_id: str, title: str) -> None:
+        self._reddit = reddit
+        self.id = submission_id
+        self.fullname = f"t3_{submission_id}"
+        self.title = title
+        self.permalink = f"/r/{SUBREDDIT_NAME}/comments/{submission_id}/tekken_dojo/"
+
+
+class FakeComment:
+    "A comment on a FakeSubmission, whose parent() walks up the generated reply tree"
+
+    __slots__ = (
+        "_reddit",
+        "_parent",
+        "id",
+        "body",
+        "author",
+        "created_utc",
+        "parent_id",
+        "submission",
+        "depth",
+    )
+
+    def __init__(
+        self,
+        reddit: "FakeReddit",
+        comment_id: str,
+        body: str,
+        author: Optional[FakeRedditor],
+        created_utc: float,
+        submission: FakeSubmission,
+        parent: Optional["FakeComment"] = None,
+    ) -> None:
+        self._reddit = reddit
+        self._parent = parent
+        self.id = comment_id
+        self.body = body
+        self.author = author
+        self.created_utc = created_utc
+        self.submission = submission
+        self.parent_id = f"t1_{parent.id}" if parent else submission.fullname
+        self.depth = parent.depth + 1 if parent else 0
+
+    @property
+    def fullname(self) -> str:
+        return f"t1_{self.id}"
+
+    @property
+    def link_id(self) -> str:
+        return self.submission.fullname
+
+    @property
+    def is_root(self) -> bool:
+        return self._parent is None
+
+    @property
+    def permalink(self) -> str:
+        return f"{self.submission.permalink}{self.id}/"
+
+    def parent(self):
+        self._reddit.count("parent")
+        return self._parent if self._parent else self.submission
+
+
+def generate_dojo_thread(
+    reddit: "FakeReddit",
+    num_comments: int,
+    start: datetime,
+    duration: float = 27 * 24 * 60 * 60,
+    num_authors: int = None,
+    seed: int = 0,
+) -> Tuple[FakeSubmission, List[FakeComment]]:
+    """
+    Generate a Dojo post and num_comments comments on it, oldest first, spread over duration seconds
+    from start.
+
+    A quarter of the comments are questions (top-level comments). The rest are replies, most of
+    which continue the newest conversation, so that reply chains grow deep (up to MAX_DEPTH) the way
+    back-and-forth explanations do. How much each author comments follows a Zipf distribution, a
+    few of the replies are the asker's follow-ups or thanks, and some accounts are deleted.
+    """
+
+    rng = random.Random(seed)
+    if num_authors is None:
+        num_authors = max(num_comments // 20, 50)
+    authors = [FakeRedditor(f"dojo_user_{i}") for i in range(num_authors)]
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, num_authors + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    picked = rng.choices(authors, cum_weights=cum_weights, k=num_comments)
+
+    submission = FakeSubmission(reddit, "dojo" + base36(seed), "Tekken Dojo")
+    reddit.submissions[submission.id] = submission
+    comments: List[FakeComment] = []
+    start_utc = start.timestamp()
+    for idx in range(num_comments):
+        move = MOVES[idx % len(MOVES)]
+        parent = None
+        if comments and rng.random() >= TOP_LEVEL_RATIO:
+            newest = comments[-1]
+            if rng.random() < CONTINUE_CHAIN_RATIO and newest.depth < MAX_DEPTH:
+                parent = newest
+            else:
+                parent = comments[-rng.randint(1, min(len(comments), RECENT_WINDOW))]
+                if parent.depth >= MAX_DEPTH:
+                    parent = None
+
+        author = picked[idx]
+        if parent is None:
+            body = rng.choice(QUESTIONS).format(move=move)
+        elif rng.random() < OP_REPLY_RATIO:
+            root = parent
+            while root._parent is not None:
+                root = root._parent
+            author = root.author
+            body = rng.choice(UNHELPFUL + ANSWERS).format(move=move)
+        elif rng.random() < UNHELPFUL_RATIO:
+            body = rng.choice(UNHELPFUL)
+        else:
+            body = rng.choice(ANSWERS).format(move=move)
+        if rng.random() < DELETED_AUTHOR_RATIO:
+            author = None
+
+        comment = FakeComment(
+            reddit,
+            base36(36**5 + seed * num_comments + idx),
+            body,
+            author,
+            start_utc + duration * idx / num_comments,
+            submission,
+            parent,
+        )
+        comments.append(comment)
+        reddit.comments[comment.id] = comment
+    return submission, comments
+
+
+def comment_stream(comments: List[FakeComment], tick_size: int) -> Iterator:
+    """
+    A stream over the comments, tick_size at a time, which yields None after every tick like a
+    PRAW stream created with pause_after=0
+    """
+
+    for idx in range(0, len(comments), tick_size):
+        yield from comments[idx : idx + tick_size]
+        yield None
+    while True:
+        yield None
+
+
+class FakeReddit:
+    "The praw.Reddit calls made by the Dojo, answered from the generated comments"
+
+    def __init__(self, deleted_ratio: float = DELETED_RATIO) -> None:
+        self.deleted_ratio = deleted_ratio
+        self.comments: Dict[str, FakeComment] = {}
+        self.submissions: Dict[str, FakeSubmission] = {}
+        self.calls: Counter = Counter()  # API call -> times it was made
+        self._lock = threading.Lock()
+
+    def count(self, call: str, times: int = 1) -> None:
+        with self._lock:
+            self.calls[call] += times
+
+    def info(self, fullnames: List[str]):
+        self.count("info")
+        for fullname in fullnames:
+            comment = self.comments.get(fullname[3:])
+            if comment is None:
+                continue
+            if random.Random(comment.id).random() < self.deleted_ratio:
+                yield FakeComment(
+                    self,
+                    comment.id,
+                    "[deleted]",
+                    None,
+                    comment.created_utc,
+                    comment.submission,
+                )
+            else:
+                yield comment
+
+
+class FakeWidgetModeration:
+    def __init__(self, widget: "FakeTextArea") -> None:
+        self.widget = widget
+
+    def update(self, **kwargs) -> "FakeTextArea":
+        widgets = self.widget._widgets
+        widgets.reddit.count("widget_update")
+        updated = FakeTextArea(
+            widgets,
+            self.widget.id,
+            kwargs.get("shortName", self.widget.shortName),
+            kwargs.get("text", self.widget.text),
+        )
+        widgets._sidebar = [
+            updated if widget.id == updated.id else widget
+            for widget in widgets._sidebar
+        ]
+        return updated
+
+
+class FakeTextArea(praw.models.TextArea):
+    "A TextArea widget, which passes the isinstance checks of the redesign code"
+
+    def __init__(
+        self, widgets: "FakeWidgets", widget_id: str, short_name: str, text: str
+    ) -> None:
+        self._widgets = widgets
+        self.id = widget_id
+        self.shortName = short_name
+        self.text = text
+
+    @property
+    def mod(self) -> FakeWidgetModeration:
+        return FakeWidgetModeration(self)
+
+
+class FakeWidgets:
+    def __init__(self, reddit: FakeReddit, short_names: List[str]) -> None:
+        self.reddit = reddit
+        self._sidebar = [
+            FakeTextArea(self, f"widget_{idx}", short_name, "")
+            for idx, short_name in enumerate(short_names)
+        ]
+
+    @property
+    def sidebar(self) -> List[FakeTextArea]:
+        return list(self._sidebar)
+
+    def refresh(self) -> None:
+        self.reddit.count("widgets_fetch")
+
+
+class FakeWikiPage:
+    def __init__(self, reddit: FakeReddit, name: str, content_md: str = "") -> None:
+        self.reddit = reddit
+        self.name = name
+        self._content_md = content_md
+        self.revision_by = FakeRedditor("tekken-bot")
+        self.revision_date = 0
+        self.revisions = 0
+
+    @property
+    def content_md(self) -> str:
+        self.reddit.count("wiki_read")
+        return self._content_md
+
+    @property
+    def revision_id(self) -> str:
+        return f"revision-{self.revisions}"
+
+    def edit(self, content: str, reason: str = None, previous: str = None) -> None:
+        "Refused with a 409 Conflict, like Reddit does, if previous is not the latest revision"
+
+        self.reddit.count("wiki_edit")
+        if previous is not None and previous != self.revision_id:
+            response = requests.Response()
+            response.status_code = 409
+            raise prawcore.exceptions.Conflict(response)
+        self._content_md = content
+        self.revision_date = int(datetime.now().timestamp())
+        self.revisions += 1
+
+
+class FakeWiki:
+    "subreddit.wiki, creating pages the first time they are read"
+
+    def __init__(self, reddit: FakeReddit, pages: Dict[str, str] = None) -> None:
+        self.reddit = reddit
+        self.pages = {
+            name: FakeWikiPage(reddit, name, content)
+            for name, content in (pages or {}).items()
+        }
+
+    def __getitem__(self, name: str) -> FakeWikiPage:
+        if name not in self.pages:
+            self.pages[name] = FakeWikiPage(reddit=self.reddit, name=name)
+        return self.pages[name]
+
+
+class FakeFlair:
+    """
+    subreddit.flair: iterating it lists every user's flair FLAIR_PAGE_SIZE at a time, calling it
+    with a user looks up that user's flair, and set()/update() change flairs
+    """
+
+    def __init__(self, reddit: FakeReddit, flairs: Dict[str, Tuple[str, str]]) -> None:
+        self.reddit = reddit
+        # username -> {"user", "flair_text", "flair_css_class"}
+        self.flairs = {
+            name: {
+                "user": FakeRedditor(name),
+                "flair_text": text,
+                "flair_css_class": css_class,
+            }
+            for name, (text, css_class) in flairs.items()
+        }
+
+    def __call__(self, redditor=None, **generator_kwargs):
+        if redditor is not None:
+            self.reddit.count("flair_lookup")
+            name = str(redditor)
+            yield self.flairs.get(
+                name,
+                {"user": FakeRedditor(name), "flair_text": None, "flair_css_class": ""},
+            )
+            return
+        for idx, flair in enumerate(list(self.flairs.values())):
+            if idx % FLAIR_PAGE_SIZE == 0:
+                self.reddit.count("flair_list")
+            yield flair
+
+    def _set(self, name: str, text: str, css_class: str) -> None:
+        self.flairs[name] = {
+            "user": FakeRedditor(name),
+            "flair_text": text,
+            "flair_css_class": css_class,
+        }
+
+    def set(
+        self, redditor, text: str = "", css_class: str = "", flair_template_id=None
+    ) -> None:
+        self.reddit.count("flair_set")
+        self._set(str(redditor), text, css_class or "")
+
+    def update(self, flair_list, css_class: str = "", text: str = "") -> List[dict]:
+        flair_list = list(flair_list)
+        self.reddit.count(
+            "flair_update",
+            (len(flair_list) + FLAIR_UPDATE_BATCH - 1) // FLAIR_UPDATE_BATCH,
+        )
+        results = []
+        for flair in flair_list:
+            if isinstance(flair, dict):
+                self._set(
+                    str(flair["user"]),
+                    flair.get("flair_text", text),
+                    flair.get("flair_css_class", css_class),
+                )
+            else:
+                self._set(str(flair), text, css_class)
+            results.append({"ok": True, "status": "added flair", "errors": {}})
+        return results
+
+
+class FakeSubredditStream:
+    def __init__(self, comments: List[FakeComment], tick_size: int) -> None:
+        self._comments = comments
+        self.tick_size = tick_size
+
+    def comments(self, **stream_options) -> Iterator:
+        return comment_stream(self._comments, self.tick_size)
+
+    def submissions(self, **stream_options) -> Iterator:
+        return comment_stream([], self.tick_size)
+
+
+class FakeSubreddit:
+    def __init__(
+        self,
+        reddit: FakeReddit,
+        dojo_post: FakeSubmission,
+        comments: List[FakeComment] = None,
+        flairs: Dict[str, Tuple[str, str]] = None,
+        tick_size: int = 100,
+    ) -> None:
+        self.reddit = reddit
+        self.display_name = SUBREDDIT_NAME
+        self.dojo_post = dojo_post
+        self.widgets = FakeWidgets(
+            reddit, ["Livestreams", "Dojo Leaderboard (Jan '21)", "Useful Stuff"]
+        )
+        self.wiki = FakeWiki(reddit, {"config/sidebar": SIDEBAR_TEXT})
+        self.flair = FakeFlair(reddit, flairs or {})
+        self.stream = FakeSubredditStream(comments or [], tick_size)
+
+    def sticky(self, number: int = 1) -> FakeSubmission:
+        self.reddit.count("sticky")
+        return self.dojo_post
+
+
+def generate_flairs(
+    num_users: int, masters: List[str], seed: int = 0
+) -> Dict[str, Tuple[str, str]]:
+    "Returns: username -> (flair text, css class) of num_users flaired users and the Dojo Masters"
+
+    rng = random.Random(seed)
+    characters = ["Kazuya", "Jin", "King", "Paul", "Law", "Nina", "Heihachi", "Lili"]
+    flairs = {
+        f"flair_user_{idx}": (rng.choice(characters), "mokujin")
+        for idx in range(num_users)
+    }
+    for name in masters:
+        flairs[name] = (
+            f"{rng.choice(characters)} | Dojo Master (Dec '20)",
+            "dojo-master",
+        )
+    return flairs
+
+
+class _HelixHandler(BaseHTTPRequestHandler):
+    server: "_HelixHTTPServer"
+
+    def _send(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        self.server.fake.count("token")
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self._send(200, {"access_token": "fake-token", "expires_in": 3600})
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        endpoint = url.path.rsplit("/", 1)[-1]
+        self.server.fake.count(endpoint)
+        streamers = self.server.fake.streamers
+        if endpoint == "streams":
+            first = int(params.get("first", ["20"])[0])
+            self._send(200, {"data": streamers[:first]})
+        elif endpoint == "users":
+            ids = set(params.get("id", []))
+            users = [
+                {"id": streamer["user_id"], "login": streamer["user_name"].lower()}
+                for streamer in streamers
+                if streamer["user_id"] in ids
+            ]
+            random.shuffle(users)
+            self._send(200, {"data": users})
+        else:
+            self._send(404, {"error": "Not Found"})
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class _HelixHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    fake: "FakeHelixServer"
+
+
+class FakeHelixServer:
+    """
+    Serves the token, streams and users endpoints of the Twitch API on 127.0.0.1. Point
+    twitch.OAUTH_URL and twitch.HELIX_URL at oauth_url and helix_url once started.
+    """
+
+    def __init__(self, num_streamers: int = 20, seed: int = 0) -> None:
+        rng = random.Random(seed)
+        self.streamers = [
+            {
+                "user_id": str(1000 + idx),
+                "user_name": f"Tekken_Streamer_{idx}",
+                "title": f"[EN] Road to {rng.choice(['Tekken God', 'Tekken King', 'Bushin'])} "
+                f"| !discord !schedule `grinding` ranked {idx}",
+                "viewer_count": rng.randint(10, 20000),
+            }
+            for idx in range(num_streamers)
+        ]
+        self.streamers.sort(key=lambda streamer: -streamer["viewer_count"])
+        self.calls: Counter = Counter()  # endpoint -> requests served
+        self._lock = threading.Lock()
+        self._server: Optional[_HelixHTTPServer] = None
+
+    def count(self, endpoint: str) -> None:
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def start(self) -> "FakeHelixServer":
+        self._server = _HelixHTTPServer(("127.0.0.1", 0), _HelixHandler)
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def oauth_url(self) -> str:
+        return f"{self.url}/oauth2/token"
+
+    @property
+    def helix_url(self) -> str:
+        return f"{self.url}/helix"
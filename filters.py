@@ -0,0 +1,142 @@
+"""
+Compiled matchers deciding which Dojo comments should not count towards a user's Dojo Points.
+
+The phrases and patterns are read once from a JSON config file (FILTER_CONFIG_PATH, or the
+DOJO_FILTER_CONFIG environment variable) of the form -
+
+    {
+        "phrases": ["you're welcome", "no problem"],
+        "patterns": ["^(thanks|thank you)[.!]*$"],
+        "word_boundary": false,
+        "max_length": null
+    }
+
+Every phrase and pattern is compiled into a single regex, with the phrases arranged as a trie, so
+checking a comment is a single scan of its lowercased body however many phrases are configured.
+"""
+
+import json
+import logging
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Pattern
+
+FILTER_CONFIG_PATH: str = (
+    "unhelpful.json"  # default config file, relative to the working dir
+)
+DEFAULT_PHRASES: List[str] = [
+    "you're welcome",
+    "no problem",
+]  # used if there is no config
+
+
+class PhraseMatcher:
+    """
+    Matches text against a set of literal phrases and regex patterns, ignoring case. Patterns are
+    matched against the lowercased text, so should be written in lowercase.
+
+    word_boundary: only match phrases which are whole words, e.g. "np" does not match "input"
+    max_length: only text of at most this many characters can match, so that long answers which
+        happen to end with "no problem!" are still counted
+    """
+
+    def __init__(
+        self,
+        phrases: Iterable[str] = (),
+        patterns: Iterable[str] = (),
+        word_boundary: bool = False,
+        max_length: Optional[int] = None,
+    ) -> None:
+        self.phrases = sorted({phrase.lower() for phrase in phrases if phrase})
+        self.patterns = list(patterns)
+        self.word_boundary = word_boundary
+        self.max_length = max_length
+        self._regex = self._compile()
+
+    def _compile(self) -> Optional[Pattern]:
+        alternatives = []
+        if self.phrases:
+            phrases = _trie_pattern(self.phrases)
+            # not \b, which never matches after a phrase ending in punctuation (e.g. "thanks!")
+            # unless a word follows it
+            alternatives.append(
+                rf"(?<!\w){phrases}(?!\w)" if self.word_boundary else phrases
+            )
+        alternatives += [f"(?:{pattern})" for pattern in self.patterns]
+        if not alternatives:
+            return None
+        return re.compile("|".join(alternatives), re.MULTILINE)
+
+    def search(self, text: str) -> Optional[str]:
+        "Returns: the first phrase or pattern match in text, or None if nothing matches"
+
+        if not text or self._regex is None:
+            return None
+        if self.max_length is not None and len(text) > self.max_length:
+            return None
+        match = self._regex.search(text.lower())
+        return match.group(0) if match else None
+
+    def matches(self, text: str) -> bool:
+        return self.search(text) is not None
+
+    def classify(self, texts: Iterable[str]) -> List[bool]:
+        "Returns: whether each of the texts matches, in order"
+
+        return [self.matches(text) for text in texts]
+
+    def __len__(self) -> int:
+        return len(self.phrases) + len(self.patterns)
+
+
+def _trie_pattern(phrases: Iterable[str]) -> str:
+    """
+    A regex matching any of the phrases, with common prefixes factored out, e.g. "no problem" and
+    "no prob" become "no prob(?:lem)?". The regex engine then only follows the phrases that
+    share the text's prefix instead of trying every phrase at every position of the text.
+    """
+
+    trie: Dict[str, dict] = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}  # marks the end of a phrase
+
+    def build(node: Dict[str, dict]) -> str:
+        branches = [
+            re.escape(char) + build(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+        optional = "" in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        return f"(?:{'|'.join(branches)})" + ("?" if optional else "")
+
+    return f"(?:{build(trie)})"
+
+
+def load_matcher(path: str = None) -> PhraseMatcher:
+    """
+    Build a matcher from the JSON config at path, DOJO_FILTER_CONFIG or FILTER_CONFIG_PATH. Falls
+    back to DEFAULT_PHRASES if the config file does not exist.
+    """
+
+    path = path or os.environ.get("DOJO_FILTER_CONFIG", FILTER_CONFIG_PATH)
+    if not os.path.exists(path):
+        logging.warning(f"No filter config at {path}, using the default phrases")
+        return PhraseMatcher(DEFAULT_PHRASES)
+
+    with open(path) as f:
+        config = json.load(f)
+    matcher = PhraseMatcher(
+        config.get("phrases", []),
+        config.get("patterns", []),
+        word_boundary=config.get("word_boundary", False),
+        max_length=config.get("max_length"),
+    )
+    logging.info(f"Loaded {len(matcher)} comment filters from {path}")
+    return matcher
@@ -0,0 +1,104 @@
+"An in-memory, tie-aware top-k leaderboard of Dojo Points for a single month."
+
+import bisect
+import threading
+from datetime import date
+from typing import Dict, List, Set, Tuple
+
+EXCLUDED_AUTHORS = {"[deleted]"}  # never ranked, same as the leaderboard query
+
+
+class Leaderboard:
+    """
+    Keeps every author's score for one month, bucketed by score. The distinct scores are kept in a
+    sorted list, so an update is a dict update plus a binary search, and ranking only walks the
+    highest few buckets.
+
+    top() returns the same (rank, user, score) tuples as dojo.tally_scores: everyone tied with the
+    k-th score is included and tied users share a rank.
+    """
+
+    def __init__(self, month: date, scores: Dict[str, int] = None) -> None:
+        self.month = month
+        self._scores: Dict[str, int] = {}
+        self._buckets: Dict[int, Set[str]] = {}  # score -> authors with that score
+        self._levels: List[int] = []  # distinct scores, ascending
+        self._lock = threading.Lock()
+        if scores:
+            self.load(scores)
+
+    def _unlink(self, author: str, score: int) -> None:
+        bucket = self._buckets[score]
+        bucket.discard(author)
+        if not bucket:
+            del self._buckets[score]
+            del self._levels[bisect.bisect_left(self._levels, score)]
+
+    def _link(self, author: str, score: int) -> None:
+        if score not in self._buckets:
+            self._buckets[score] = set()
+            bisect.insort(self._levels, score)
+        self._buckets[score].add(author)
+
+    def add(self, author: str, delta: int = 1) -> None:
+        "Change an author's score by delta, dropping them once they reach 0 points"
+
+        if author in EXCLUDED_AUTHORS or delta == 0:
+            return
+        with self._lock:
+            old = self._scores.get(author, 0)
+            new = old + delta
+            if old > 0:
+                self._unlink(author, old)
+            if new > 0:
+                self._scores[author] = new
+                self._link(author, new)
+            else:
+                self._scores.pop(author, None)
+
+    def load(self, scores: Dict[str, int]) -> None:
+        "Replace every score with the given author -> score mapping"
+
+        with self._lock:
+            self._scores = {}
+            self._buckets = {}
+            self._levels = []
+            for author, score in scores.items():
+                if author not in EXCLUDED_AUTHORS and score > 0:
+                    self._scores[author] = score
+                    self._buckets.setdefault(score, set()).add(author)
+            self._levels = sorted(self._buckets)
+
+    def top(self, k: int) -> List[Tuple[int, str, int]]:
+        "Returns: (rank, user, score) for everyone scoring at least the k-th highest score"
+
+        leaders: List[Tuple[int, str, int]] = []
+        with self._lock:
+            for rank, score in enumerate(reversed(self._levels), start=1):
+                if len(leaders) >= k:
+                    break
+                for author in sorted(self._buckets[score]):
+                    leaders.append((rank, author, score))
+        return leaders
+
+    def scores(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._scores)
+
+    def drift(self, scores: Dict[str, int]) -> Dict[str, Tuple[int, int]]:
+        "Returns: author -> (in-memory score, given score) for every author whose score differs"
+
+        expected = {
+            author: score
+            for author, score in scores.items()
+            if author not in EXCLUDED_AUTHORS and score > 0
+        }
+        current = self.scores()
+        return {
+            author: (current.get(author, 0), expected.get(author, 0))
+            for author in current.keys() | expected.keys()
+            if current.get(author, 0) != expected.get(author, 0)
+        }
+
+    def __len__(self) -> int:
+        return len(self._scores)
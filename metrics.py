@@ -0,0 +1,178 @@
+"""
+Counters and latency histograms of the bot's tasks and outbound calls (Reddit, Twitch, Postgres).
+
+They are served in the Prometheus text format on http://127.0.0.1:METRICS_PORT/metrics (the port can
+be changed with the METRICS_PORT environment variable) and summarised in the logs by
+log_summary().
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+METRICS_PORT: int = 9108  # default port of the metrics endpoint
+METRICS_HOST: str = "127.0.0.1"  # only reachable from the dyno itself
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS: Tuple[float, ...] = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_counters: Dict[Tuple[str, Labels], float] = {}
+_histograms: Dict[Tuple[str, Labels], "Histogram"] = {}
+_lock = threading.Lock()
+_server: Optional[ThreadingHTTPServer] = None
+
+
+class Histogram:
+    "Counts of observations per bucket, plus their count and sum"
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    "Add value to the counter name with the given labels"
+
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    "Record a latency in seconds in the histogram name with the given labels"
+
+    key = (name, _labels(labels))
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(value)
+
+
+@contextmanager
+def timer(name: str, **labels):
+    "Record how long the with block took in the histogram name"
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        (key, value.replace("\\", "\\\\").replace('"', '\\"')) for key, value in pairs
+    ]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def render() -> str:
+    "Returns: every metric in the Prometheus text exposition format"
+
+    lines: List[str] = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(
+            (key, (list(h.buckets), h.count, h.sum)) for key, h in _histograms.items()
+        )
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), (buckets, count, total) in histograms:
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket in zip(list(BUCKETS) + ["+Inf"], buckets):
+            cumulative += bucket
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, (('le', str(bound)),))} {cumulative}"
+            )
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    "Returns: one line per histogram with its count, mean and max, and one per counter"
+
+    lines = []
+    with _lock:
+        for (name, labels), h in sorted(_histograms.items()):
+            mean = h.sum / h.count if h.count else 0.0
+            lines.append(
+                f"{name}{_format_labels(labels)}: {h.count} calls, "
+                f"mean {mean:.3f}s, max {h.max:.3f}s"
+            )
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(f"{name}{_format_labels(labels)}: {value:g}")
+    return "\n".join(lines)
+
+
+def log_summary() -> None:
+    logging.info(f"Metrics summary -\n{summary()}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(format % args)
+
+
+def start_server(port: int = None) -> ThreadingHTTPServer:
+    "Serve the metrics on METRICS_HOST from a daemon thread"
+
+    global _server
+    port = port or int(os.environ.get("METRICS_PORT", METRICS_PORT))
+    _server = ThreadingHTTPServer((METRICS_HOST, port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+    return _server
+
+
+def observe_response(service: str):
+    "Returns: a requests response hook counting the calls to service and their latency"
+
+    def hook(response, *args, **kwargs) -> None:
+        inc("http_requests_total", service=service, status=response.status_code)
+        observe(
+            "http_request_duration_seconds",
+            response.elapsed.total_seconds(),
+            service=service,
+        )
+
+    return hook
@@ -1,8 +1,174 @@
+import hashlib
+import json
 import logging
 import re
+import threading
+import time
 import traceback
+from typing import Dict, List, Optional, Tuple
 
 import praw
+import prawcore
+
+import storage
+
+MAX_STALENESS: float = 60 * 60  # rewrite unchanged text after this many seconds anyway
+SIDEBAR_EDIT_ATTEMPTS: int = (
+    3  # edits of the sidebar page before giving up on conflicts
+)
+# the "Last updated" line at the end of every generated text, left out of fingerprints
+FOOTER_PATTERN = re.compile(r"^\^\(Last updated: .*\)$", re.MULTILINE)
+
+_written: Dict[str, Tuple[str, float]] = {}  # target -> (fingerprint, time written)
+_written_lock = threading.Lock()
+
+
+def fingerprint(*parts: str) -> str:
+    "A hash of the given texts, ignoring their 'Last updated' footers"
+
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(FOOTER_PATTERN.sub("", part or "").strip().encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _last_written(target: str) -> Optional[Tuple[str, float]]:
+    with _written_lock:
+        if target in _written:
+            return _written[target]
+    try:
+        value = storage.get_storage().get_state(f"written:{target}")
+    except Exception:
+        logging.error(traceback.format_exc())
+        return None
+    if value is None:
+        return None
+    state = json.loads(value)
+    written = (state["fingerprint"], state["time"])
+    with _written_lock:
+        _written[target] = written
+    return written
+
+
+def is_changed(target: str, key: str, max_staleness: float = None) -> bool:
+    """
+    Returns: True if target (e.g. a widget) should be written, i.e. its fingerprint key differs
+    from the one last written or the last write is older than max_staleness (default:
+    MAX_STALENESS) seconds
+    """
+
+    if max_staleness is None:
+        max_staleness = MAX_STALENESS
+    written = _last_written(target)
+    if written is None or written[0] != key:
+        return True
+    if time.time() - written[1] > max_staleness:
+        logging.debug(f"{target} is unchanged but stale, refreshing it")
+        return True
+    logging.debug(f"{target} is unchanged, skipping the write")
+    return False
+
+
+def mark_written(target: str, key: str) -> None:
+    "Remember that target was written with fingerprint key, in memory and in storage"
+
+    written = (key, time.time())
+    with _written_lock:
+        _written[target] = written
+    try:
+        storage.get_storage().set_state(
+            f"written:{target}",
+            json.dumps({"fingerprint": written[0], "time": written[1]}),
+        )
+    except Exception:
+        logging.error(traceback.format_exc())
+
+
+class WidgetIndex:
+    """
+    The sidebar widgets of a subreddit by shortName, so that updates go straight to the widget
+    instead of scanning subreddit.widgets.sidebar each time.
+
+    The index is rebuilt from a fresh fetch of the widgets whenever a lookup misses, and entries
+    are moved when a widget is renamed through rename().
+    """
+
+    def __init__(self, subreddit) -> None:
+        self.subreddit = subreddit
+        self._widgets: Optional[Dict[str, object]] = None  # shortName -> widget
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _build(self) -> None:
+        self._widgets = {
+            widget.shortName: widget for widget in self.subreddit.widgets.sidebar
+        }
+        logging.debug(f"Indexed sidebar widgets: {', '.join(self._widgets)}")
+
+    def refresh(self) -> None:
+        "Fetch the widgets again, e.g. to read data which was changed on Reddit"
+
+        with self._lock:
+            self.subreddit.widgets.refresh()
+            self._build()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._widgets = None
+
+    def _match(self, short_name: str, kind: type = None):
+        candidates = [self._widgets.get(short_name)] + [
+            widget for name, widget in self._widgets.items() if short_name in name
+        ]
+        for widget in candidates:
+            if widget is not None and (kind is None or isinstance(widget, kind)):
+                return widget
+        return None
+
+    def find(self, short_name: str, kind: type = None):
+        """
+        Returns: the widget called short_name, or else the first widget whose shortName contains
+        short_name (optionally only of the given type), or None if there is none even after
+        refetching the widgets
+        """
+
+        with self._lock:
+            if self._widgets is None:
+                self._build()
+            widget = self._match(short_name, kind)
+            if widget is not None:
+                self.hits += 1
+                return widget
+            self.misses += 1
+            logging.debug(f"No widget {short_name} in the index, refetching widgets")
+            self.subreddit.widgets.refresh()
+            self._build()
+            return self._match(short_name, kind)
+
+    def rename(self, widget, updated) -> None:
+        "Replace widget with updated, the widget returned by widget.mod.update()"
+
+        with self._lock:
+            if self._widgets is None:
+                return
+            self._widgets.pop(widget.shortName, None)
+            self._widgets[updated.shortName] = updated
+
+
+_widget_indexes: Dict[str, WidgetIndex] = {}  # subreddit name -> its widgets
+_widget_indexes_lock = threading.Lock()
+
+
+def get_widgets(subreddit) -> WidgetIndex:
+    "The process-wide widget index of a subreddit"
+
+    with _widget_indexes_lock:
+        name = subreddit.display_name.lower()
+        if name not in _widget_indexes:
+            _widget_indexes[name] = WidgetIndex(subreddit)
+        return _widget_indexes[name]
 
 
 def update_sidebar_widget(
@@ -13,14 +179,187 @@ def update_sidebar_widget(
     logging.debug(
         f"Attempting to update sidebar widget with shortName: {short_name}, newShortName: {new_short_name}, text: \n{text}"
     )
-    for w in subreddit.widgets.sidebar:
-        if isinstance(w, praw.models.TextArea):
-            if short_name in w.shortName:
-                if len(text) > 0:
-                    w.mod.update(shortName=new_short_name, text=text)
+    target = f"widget:{short_name}"
+    key = fingerprint(new_short_name, text)
+    if len(text) == 0 or not is_changed(target, key):
+        return
+    widgets = get_widgets(subreddit)
+    w = widgets.find(short_name, praw.models.TextArea)
+    if w is None:
+        logging.error(f"No {short_name} widget in the sidebar")
+        return
+    try:
+        updated = w.mod.update(shortName=new_short_name, text=text)
+    except Exception:
+        # the widget may have been deleted or replaced, look it up again next time
+        widgets.invalidate()
+        raise
+    widgets.rename(w, updated)
+    mark_written(target, key)
     logging.info(f"Successfully updated {new_short_name} widget")
 
 
+class SidebarDocument:
+    """
+    The config/sidebar wiki page behind the old Reddit sidebar, split on '****' into sections
+    which are indexed by their '# Heading'.
+
+    Tasks queue section updates with update() and text replacements with replace(). flush() then
+    applies everything queued on top of the latest revision of the page with a single edit, so the
+    tasks neither overwrite each other's sections nor create a revision each. If the page changed
+    since the bot last wrote it (a moderator edited it), the outside edit is kept and logged.
+    """
+
+    def __init__(self, subreddit, page: str = "config/sidebar") -> None:
+        self.subreddit = subreddit
+        self.page = page
+        # section title -> (new title, text, (target, fingerprint) to mark as written)
+        self._pending: Dict[str, Tuple[str, str, Tuple[str, str]]] = {}
+        self._replacements: List[Tuple[str, str]] = []
+        self._written_text: Optional[str] = None  # the page as the bot last wrote it
+        self._lock = threading.Lock()  # guards the queued changes
+        self._flush_lock = threading.Lock()  # one read-modify-write at a time
+
+    def update(
+        self,
+        section_title: str,
+        text: str,
+        new_section_title: str = None,
+        written: Tuple[str, str] = None,
+    ) -> None:
+        "Queue replacing the section headed section_title, superseding any queued update of it"
+
+        with self._lock:
+            self._pending[section_title] = (
+                new_section_title or section_title,
+                text,
+                written,
+            )
+
+    def replace(self, old: str, new: str) -> None:
+        "Queue replacing every occurrence of old in the page with new"
+
+        with self._lock:
+            self._replacements.append((old, new))
+
+    @staticmethod
+    def _index(sections: List[str]) -> Dict[str, int]:
+        "Returns: heading -> index of the section it heads"
+
+        index = {}
+        for idx, section in enumerate(sections):
+            match = re.search(r"^#+ *(.+?)\s*$", section, flags=re.MULTILINE)
+            if match:
+                index.setdefault(match.group(1), idx)
+        return index
+
+    def _edit(
+        self, pending: Dict[str, Tuple[str, str, Tuple[str, str]]], replacements
+    ) -> Tuple[bool, List[str]]:
+        """
+        Apply the changes to the latest revision of the page, editing it only if that revision is
+        still the latest one
+
+        Returns: (True if the page was edited, titles of the pending sections not in the page)
+        """
+
+        sidebar = self.subreddit.wiki[self.page]
+        sidebar_text = sidebar.content_md
+        if self._written_text is not None and sidebar_text != self._written_text:
+            logging.warning(
+                f"{self.page} was edited outside the bot by {sidebar.revision_by} at "
+                f"{sidebar.revision_date}, applying updates on top of it"
+            )
+
+        sections = sidebar_text.split("****")
+        index = self._index(sections)
+        missing = []
+        for section_title, (new_title, text, _) in pending.items():
+            heading = section_title.title()
+            idx = next(
+                (idx for title, idx in index.items() if title.startswith(heading)),
+                None,
+            )
+            if idx is None:
+                logging.error(f"No section '{heading}' in {self.page}")
+                missing.append(section_title)
+                continue
+            sections[idx] = f"\n\n# {new_title.title()}\n\n{text}\n\n"
+        new_sidebar_text = "****".join(sections)
+        for old, new in replacements:
+            new_sidebar_text = new_sidebar_text.replace(old, new)
+
+        edited = new_sidebar_text != sidebar_text
+        if edited:
+            logging.debug(f"New sidebar text: {new_sidebar_text}")
+            # Reddit refuses the edit with a conflict if the page changed since it was read
+            sidebar.edit(
+                content=new_sidebar_text,
+                reason=f"Updated {', '.join(pending) or 'links'}",
+                previous=sidebar.revision_id,
+            )
+            logging.info(
+                f"Successfully updated sidebar description ({len(pending)} sections)"
+            )
+        self._written_text = new_sidebar_text
+        return edited, missing
+
+    def flush(self) -> bool:
+        """
+        Write every queued change to the page in a single edit, starting over from the latest
+        revision if the page is edited in the meantime
+
+        Returns: True if the page was edited
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                replacements, self._replacements = self._replacements, []
+            if not pending and not replacements:
+                return False
+
+            try:
+                for attempt in range(1, SIDEBAR_EDIT_ATTEMPTS + 1):
+                    try:
+                        edited, missing = self._edit(pending, replacements)
+                        break
+                    except prawcore.exceptions.Conflict:
+                        if attempt == SIDEBAR_EDIT_ATTEMPTS:
+                            raise
+                        logging.warning(
+                            f"{self.page} was edited during the update, retrying"
+                        )
+            except Exception:
+                logging.error(traceback.format_exc())
+                # keep what was queued for the next flush, unless newer updates replaced it
+                with self._lock:
+                    for section_title, update in pending.items():
+                        self._pending.setdefault(section_title, update)
+                    self._replacements = replacements + self._replacements
+                return False
+
+        # a section which is not in the page was not written
+        for section_title, (_, _, written) in pending.items():
+            if written and section_title not in missing:
+                mark_written(*written)
+        return edited
+
+
+_sidebars: Dict[str, SidebarDocument] = {}  # subreddit name -> its sidebar
+_sidebars_lock = threading.Lock()
+
+
+def get_sidebar(subreddit) -> SidebarDocument:
+    "The process-wide sidebar document of a subreddit"
+
+    with _sidebars_lock:
+        name = subreddit.display_name.lower()
+        if name not in _sidebars:
+            _sidebars[name] = SidebarDocument(subreddit)
+        return _sidebars[name]
+
+
 def update_sidebar_old(
     subreddit, section_title: str, text: str, new_section_title: str = None
 ) -> None:
@@ -29,7 +368,8 @@ def update_sidebar_old(
     Ref.: https://www.reddit.com/r/redditdev/comments/apqb56/prawusing_praw_to_change_the_sidebardescription/egaj792
 
     Uses the section param to determine which heading to match, to obtain the content to be replaced
-    with the text param.
+    with the text param. The update is queued on the subreddit's SidebarDocument and written by its
+    next flush.
     """
 
     if not new_section_title:
@@ -38,23 +378,10 @@ def update_sidebar_old(
     logging.debug(
         f"Updating sidebar on old Reddit for section {section_title} with text {text}"
     )
-    sidebar = subreddit.wiki["config/sidebar"]
-    sidebar_text = sidebar.content_md
-    logging.debug(f"Obtained sidebar description: {sidebar_text}")
-    try:
-        sections = re.split(r"\*\*\*\*", sidebar_text)
-        for idx, section in enumerate(sections):
-            if f"# {section_title.title()}" in section:
-                relevant_section = section
-                relevant_idx = idx
-                break
-        logging.debug(f"Relevant section: {relevant_section}")
-        section_text = f"\n\n# {new_section_title.title()}\n\n{text}\n\n"
-        logging.debug(f"New relevant section text: {section_text}")
-        sections[relevant_idx] = section_text
-        new_sidebar_text = "****".join(sections)
-        logging.debug(f"New sidebar text: {new_sidebar_text}")
-        sidebar.edit(new_sidebar_text)
-        logging.info("Successfully updated sidebar description")
-    except Exception:
-        logging.error(traceback.format_exc())
+    target = f"sidebar:{section_title}"
+    key = fingerprint(new_section_title, text)
+    if not is_changed(target, key):
+        return
+    get_sidebar(subreddit).update(
+        section_title, text, new_section_title, written=(target, key)
+    )
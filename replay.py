@@ -0,0 +1,283 @@
+"""
+Records the bot's Reddit and Twitch traffic to a capture file, and plays a capture back to the bot
+without any network access.
+
+A capture is a gzipped JSON lines file with one response per line: when it was received (seconds
+since the capture started), the request method and URL, and the response status, latency, rate limit
+headers and body. Captures are sanitized as they are written - request headers and bodies (which
+carry the bot's credentials) are never written, credential query parameters are dropped and tokens
+in response bodies are redacted.
+
+Both directions work through a requests transport adapter mounted on the PRAW session
+(budget.get_session()) and the Twitch session (twitch.get_session()), so PRAW, prawcore and the
+Twitch code run unchanged -
+
+    python task_runner.py --record capture.jsonl.gz
+    python task_runner.py --replay capture.jsonl.gz --speed 10
+
+When replaying, every recorded response of a request (same method and URL) is served in order, not
+before the time it was recorded at, and the last one is served again once they run out (e.g. to
+the later polls of a listing). The capture's clock runs speed times faster than the wall clock.
+"""
+
+import gzip
+import json
+import logging
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from datetime import timedelta
+from typing import Deque, Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import budget
+import twitch
+
+REDACTED: str = "[redacted]"
+# query parameters which are dropped from recorded URLs, and ignored when matching requests
+SENSITIVE_PARAMS = {"client_id", "client_secret", "password", "username", "code"}
+# keys of response bodies whose values are redacted
+SENSITIVE_KEYS = {"access_token", "refresh_token", "modhash", "email", "client_secret"}
+KEPT_HEADERS = (
+    "content-type",
+    "x-ratelimit-remaining",
+    "x-ratelimit-used",
+    "x-ratelimit-reset",
+)
+
+
+class ReplayMiss(requests.exceptions.ConnectionError):
+    "Raised for a request which has no recorded response in the capture being replayed"
+
+
+def request_key(method: str, url: str) -> str:
+    "Returns: 'METHOD url' with the credential parameters dropped and the rest of the query sorted"
+
+    parts = urlsplit(url)
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name not in SENSITIVE_PARAMS
+    )
+    return f"{method.upper()} {urlunsplit(parts._replace(query=urlencode(query)))}"
+
+
+def sanitize(value):
+    "Returns: a copy of a decoded JSON body with the values of SENSITIVE_KEYS redacted"
+
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in SENSITIVE_KEYS else sanitize(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [sanitize(item) for item in value]
+    return value
+
+
+class CaptureWriter:
+    "Appends sanitized responses to a gzipped JSON lines capture file, from any thread"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.records = 0
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, service: str, response: requests.Response) -> None:
+        try:
+            body = sanitize(response.json())
+        except ValueError:
+            body = response.text
+        record = {
+            "t": round(time.monotonic() - self._start, 3),
+            "service": service,
+            "key": request_key(response.request.method, response.request.url),
+            "status": response.status_code,
+            "elapsed": response.elapsed.total_seconds(),
+            "headers": {
+                name: response.headers[name]
+                for name in KEPT_HEADERS
+                if name in response.headers
+            },
+            "body": body,
+        }
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self.records += 1
+
+    def flush(self) -> None:
+        "Make everything written so far readable, even if the bot is killed before close()"
+
+        with self._lock:
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class RecordingAdapter(HTTPAdapter):
+    "Sends requests over the network and writes every response to the capture"
+
+    def __init__(self, writer: CaptureWriter, service: str) -> None:
+        super().__init__()
+        self.writer = writer
+        self.service = service
+
+    def send(self, request, **kwargs) -> requests.Response:
+        response = super().send(request, **kwargs)
+        try:
+            self.writer.write(self.service, response)
+        except Exception:
+            logging.error(traceback.format_exc())
+        return response
+
+
+class Replay:
+    """
+    The responses of a capture, served in the order and (speed times faster) at the pace they were
+    recorded at
+    """
+
+    def __init__(self, path: str, speed: float = 1.0) -> None:
+        self.path = path
+        self.speed = speed
+        self._responses: Dict[str, Deque[dict]] = {}  # request key -> its responses
+        self.duration = 0.0  # time of the last recorded response
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    record = json.loads(line)
+                    self._responses.setdefault(record["key"], deque()).append(record)
+                    self.duration = max(self.duration, record["t"])
+            except (EOFError, ValueError):
+                # the recording bot was killed, the capture ends at its last flush
+                logging.warning(
+                    f"{path} is truncated, replaying it up to its last flush"
+                )
+        self.served: Counter = Counter()  # service -> responses served
+        self.misses: Counter = Counter()  # request key -> requests without a response
+        self._start: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            self._start = time.monotonic()
+
+    def clock(self) -> float:
+        "Returns: the current time of the capture, in seconds since it started"
+
+        with self._lock:
+            if self._start is None:
+                self._start = time.monotonic()
+            return (time.monotonic() - self._start) * self.speed
+
+    def finished(self) -> bool:
+        return self.clock() > self.duration
+
+    def _next(self, key: str) -> Optional[dict]:
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                return None
+            return responses.popleft() if len(responses) > 1 else responses[0]
+
+    def respond(self, request) -> requests.Response:
+        key = request_key(request.method, request.url)
+        record = self._next(key)
+        if record is None:
+            with self._lock:
+                self.misses[key] += 1
+            raise ReplayMiss(f"No recorded response for {key}", request=request)
+
+        # not before the response was recorded, and only as fast as it was received
+        wait = (record["t"] - record["elapsed"] - self.clock()) / self.speed
+        time.sleep(max(wait, 0.0) + record["elapsed"] / self.speed)
+
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.headers = CaseInsensitiveDict(record["headers"])
+        body = record["body"]
+        response._content = (
+            body if isinstance(body, str) else json.dumps(body)
+        ).encode()
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.reason = "Replayed"
+        response.elapsed = timedelta(seconds=record["elapsed"])
+        with self._lock:
+            self.served[record["service"]] += 1
+        return response
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "served": dict(self.served),
+                "misses": sum(self.misses.values()),
+                "missed": dict(self.misses.most_common(10)),
+            }
+
+
+class ReplayAdapter(HTTPAdapter):
+    "Answers every request from a Replay, never touching the network"
+
+    def __init__(self, replay: Replay) -> None:
+        super().__init__()
+        self.replay = replay
+
+    def send(self, request, **kwargs) -> requests.Response:
+        return self.replay.respond(request)
+
+
+def _sessions() -> Dict[str, requests.Session]:
+    return {"reddit": budget.get_session(), "twitch": twitch.get_session()}
+
+
+def record(path: str) -> CaptureWriter:
+    "Start writing every Reddit and Twitch response to the capture file at path"
+
+    writer = CaptureWriter(path)
+    for service, session in _sessions().items():
+        adapter = RecordingAdapter(writer, service)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    logging.info(f"Recording Reddit and Twitch responses to {path}")
+    return writer
+
+
+def replay(path: str, speed: float = 1.0) -> Replay:
+    "Answer every Reddit and Twitch request from the capture file at path"
+
+    player = Replay(path, speed)
+    player.start()
+    adapter = ReplayAdapter(player)
+    for session in _sessions().values():
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    logging.info(
+        f"Replaying {player.duration:.0f}s of responses from {path} at {speed}x"
+    )
+    return player
+
+
+def accelerate_schedule(jobs: List, elapsed: float, speed: float) -> None:
+    """
+    Bring every scheduled job forward by the time which passes on the capture's clock but not on
+    the wall clock in elapsed seconds, so that the schedule runs speed times faster
+    """
+
+    if speed <= 1:
+        return
+    shift = timedelta(seconds=elapsed * (speed - 1))
+    for job in jobs:
+        if job.next_run is not None:
+            job.next_run -= shift
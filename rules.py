@@ -0,0 +1,264 @@
+"""
+A rule engine which moderates new submissions in a single pass over the submission stream.
+
+Rules are read once from a JSON config file (RULES_CONFIG_PATH, or the MODERATION_RULES_CONFIG
+environment variable) of the form -
+
+    {
+        "rules": [
+            {
+                "name": "Off-schedule shitpost",
+                "flair": "Shit Post",
+                "days": [5],
+                "action": "remove",
+                "removal_reason": "Off-schedule shitpost"
+            },
+            {
+                "name": "New account selling accounts",
+                "title_pattern": "\\bselling\\b.*\\baccount",
+                "max_account_age_days": 7,
+                "action": "report",
+                "report_reason": "Possible account seller"
+            }
+        ]
+    }
+
+A rule applies to a submission when all of its conditions hold -
+- flair: the submission has exactly this flair text
+- days: the submission was not made on any of these ISO weekdays [1, 7], in any timezone
+- title_pattern: the title matches this regex, ignoring case
+- max_account_age_days: the author's account is younger than this many days
+
+Rules are indexed by flair, so a submission is only checked against the rules for its flair and
+the rules without one. The first rule which applies decides the submission's action, either
+'remove' (with a removal reason and a public removal message) or 'report'.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+import cache
+import streams
+
+RULES_CONFIG_PATH: str = (
+    "rules.json"  # default config file, relative to the working dir
+)
+AUTHOR_CACHE_SIZE: int = 5000  # authors whose account creation time is kept in memory
+AUTHOR_CACHE_TTL: float = 24 * 60 * 60  # seconds before an author is looked up again
+
+SECONDS_PER_DAY = 24 * 60 * 60
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+EPOCH_WEEKDAY = 4  # days from Monday to Thursday 1 Jan 1970, the start of Unix time
+# a post lies on a day if it does so in any timezone between UTC-12:00 and UTC+14:00, i.e. if it
+# was made between 14 hours before the day starts in UTC and 12 hours after it ends in UTC
+EARLIEST_OFFSET = 14 * 60 * 60
+LATEST_OFFSET = 12 * 60 * 60
+
+ACTIONS = ("remove", "report")
+
+_account_created = cache.TTLCache(
+    AUTHOR_CACHE_SIZE, AUTHOR_CACHE_TTL
+)  # name -> created_utc
+_removal_reasons: Dict[
+    Tuple[str, str], object
+] = {}  # (subreddit, title) -> removal reason
+_removal_reasons_lock = threading.Lock()
+
+
+def posting_window(day: int) -> Tuple[int, int]:
+    """
+    Returns: the (start, length) in seconds since Monday 00:00 UTC of the window in which a post
+    lies on the ISO weekday day in some timezone. start may be negative, i.e. in the previous week.
+    """
+
+    start = (day - 1) * SECONDS_PER_DAY - EARLIEST_OFFSET
+    return start, EARLIEST_OFFSET + SECONDS_PER_DAY + LATEST_OFFSET
+
+
+def lies_on_day(created_utc: float, day: int) -> bool:
+    "Returns: True if the timestamp lies on the ISO weekday day in any timezone"
+
+    start, length = posting_window(day)
+    second_of_week = (
+        int(created_utc) - EPOCH_WEEKDAY * SECONDS_PER_DAY
+    ) % SECONDS_PER_WEEK
+    return (second_of_week - start) % SECONDS_PER_WEEK < length
+
+
+def get_removal_reason(subreddit, title: str, refresh: bool = False):
+    "The removal reason called title, looked up once per subreddit unless refresh is True"
+
+    key = (subreddit.display_name.lower(), title)
+    with _removal_reasons_lock:
+        if refresh or key not in _removal_reasons:
+            for removal_reason in subreddit.mod.removal_reasons:
+                if removal_reason.title == title:
+                    _removal_reasons[key] = removal_reason
+                    break
+        return _removal_reasons.get(key)
+
+
+def _account_age(submission) -> Optional[float]:
+    "Returns: the age in seconds of the submission author's account, or None if it was deleted"
+
+    if not submission.author:
+        return None
+    name = submission.author.name
+    created_utc = _account_created.get(name)
+    if created_utc is None:
+        created_utc = submission.author.created_utc  # fetches the author
+        _account_created.put(name, created_utc)
+    return time.time() - created_utc
+
+
+class Rule:
+    "A compiled moderation rule, see the module docstring for its fields"
+
+    def __init__(
+        self,
+        name: str,
+        action: str,
+        flair: str = None,
+        days: Iterable[int] = (),
+        title_pattern: str = None,
+        max_account_age_days: float = None,
+        removal_reason: str = None,
+        report_reason: str = None,
+    ) -> None:
+        if action not in ACTIONS:
+            raise ValueError(f"Rule '{name}' has unknown action '{action}'")
+        if action == "remove" and not removal_reason:
+            raise ValueError(f"Rule '{name}' removes posts but has no removal_reason")
+        days = list(days)
+        self.name = name
+        self.action = action
+        self.flair = flair
+        self.days = [day for day in days if day in range(1, 8)]
+        if len(self.days) != len(days):
+            logging.warning(f"Rule '{name}' has days outside [1, 7], ignoring them")
+        self.title_regex: Optional[Pattern] = (
+            re.compile(title_pattern, re.IGNORECASE) if title_pattern else None
+        )
+        self.max_account_age: Optional[float] = (
+            max_account_age_days * SECONDS_PER_DAY
+            if max_account_age_days is not None
+            else None
+        )
+        self.removal_reason = removal_reason
+        self.report_reason = report_reason or name
+
+    def applies(self, submission) -> bool:
+        "Returns: True if every condition of the rule holds, checking the cheapest ones first"
+
+        if self.flair is not None and submission.link_flair_text != self.flair:
+            return False
+        if self.days and any(
+            lies_on_day(submission.created_utc, day) for day in self.days
+        ):
+            return False
+        if self.title_regex and not self.title_regex.search(submission.title):
+            return False
+        if self.max_account_age is not None:
+            age = _account_age(submission)
+            if age is None or age >= self.max_account_age:
+                return False
+        return True
+
+    def __repr__(self) -> str:
+        return f"Rule({self.name!r}, {self.action!r})"
+
+
+class RuleEngine:
+    "Evaluates rules against submissions and applies the resulting actions in batches"
+
+    def __init__(self, rules: List[Rule]) -> None:
+        self.rules = rules
+        # rules which apply whatever the flair, and flair -> the rules for that flair plus those,
+        # both in config order
+        self._generic = [rule for rule in rules if rule.flair is None]
+        self._by_flair: Dict[str, List[Rule]] = {
+            flair: [rule for rule in rules if rule.flair in (flair, None)]
+            for flair in {rule.flair for rule in rules if rule.flair is not None}
+        }
+
+    def evaluate(self, submission) -> Optional[Rule]:
+        "Returns: the first rule (in config order) which applies to the submission, or None"
+
+        for rule in self._by_flair.get(submission.link_flair_text, self._generic):
+            if rule.applies(submission):
+                return rule
+        return None
+
+    def run(self, subreddit, stream) -> int:
+        """
+        Evaluate every submission waiting in the stream, then apply all the actions
+
+        Returns: the number of submissions acted on
+        """
+
+        actions: List[Tuple[Rule, object]] = []
+        while submission := next(stream):
+            logging.debug(submission.title)
+            try:
+                rule = self.evaluate(submission)
+            except Exception:
+                logging.error(traceback.format_exc())
+                continue
+            if rule:
+                logging.info(
+                    f"Rule '{rule.name}' applies to https://www.reddit.com{submission.permalink}"
+                )
+                actions.append((rule, submission))
+
+        for rule, submission in actions:
+            try:
+                self._apply(subreddit, rule, submission)
+            except Exception:
+                logging.error(traceback.format_exc())
+        streams.commit(stream)
+        return len(actions)
+
+    def _apply(self, subreddit, rule: Rule, submission) -> None:
+        if rule.action == "report":
+            submission.report(rule.report_reason)
+            return
+
+        removal_reason = get_removal_reason(subreddit, rule.removal_reason)
+        try:
+            logging.debug(f"Removing post with removal reason id {removal_reason.id}")
+            submission.mod.remove(reason_id=removal_reason.id)
+        except Exception:
+            # the removal reason may have been edited or deleted since it was cached
+            logging.warning(
+                "Removal with the cached removal reason failed, refreshing it"
+            )
+            removal_reason = get_removal_reason(
+                subreddit, rule.removal_reason, refresh=True
+            )
+            submission.mod.remove(reason_id=removal_reason.id)
+        logging.debug(f"Sending removal message {removal_reason.message}")
+        submission.mod.send_removal_message(removal_reason.message, type="public")
+
+
+def load_engine(path: str = None, default_rules: List[Rule] = None) -> RuleEngine:
+    """
+    Build an engine from the JSON config at path, MODERATION_RULES_CONFIG or RULES_CONFIG_PATH.
+    Falls back to default_rules if the config file does not exist.
+    """
+
+    path = path or os.environ.get("MODERATION_RULES_CONFIG", RULES_CONFIG_PATH)
+    if not os.path.exists(path):
+        logging.warning(f"No moderation rules at {path}, using the default rules")
+        return RuleEngine(default_rules or [])
+
+    with open(path) as f:
+        config = json.load(f)
+    engine = RuleEngine([Rule(**rule) for rule in config.get("rules", [])])
+    logging.info(f"Loaded {len(engine.rules)} moderation rules from {path}")
+    return engine
@@ -0,0 +1,1355 @@
+"""
+Storage backends for the Dojo system.
+
+Every Dojo code path (ingestion, tallying, health checks, wiki publishing and cleanup) talks to a
+Storage, so the same workflows can run against the production Postgres database, a local SQLite file
+or a throwaway in-memory store. The backend is picked with the DOJO_STORAGE environment variable.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import traceback
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import db
+
+TABLE_NAME: str = "dojo_comments"  # table where Tekken Dojo comments are stored
+SCORES_TABLE_NAME: str = "dojo_scores"  # per-(month, author) counts of TABLE_NAME rows
+STATE_TABLE_NAME: str = "bot_state"  # key -> value facts kept across restarts
+MASTERS_TABLE_NAME: str = "dojo_masters"  # Dojo Masters and the flair they had before
+BATCH_INGEST: bool = True  # write each tick of comments with a single statement
+SQLITE_PATH: str = "dojo.sqlite3"  # default database file of the SQLite backend
+SQLITE_MAX_VARIABLES: int = 500  # ids bound per statement, below SQLite's limit of 999
+DELETED_AUTHOR: str = "[deleted]"  # author of deleted comments, never ranked
+PARTITIONS_AHEAD: int = 3  # months of comment partitions created ahead of time
+
+# (id, created_utc, author, root_id, root_author) of a comment stored in the db
+CommentRecord = Tuple[str, datetime, str, str, Optional[str]]
+# (username, month of the Dojo Master flair, flair text before it was awarded) of a Dojo Master
+MasterRecord = Tuple[str, date, Optional[str]]
+
+_storage: Optional["Storage"] = None
+_storage_lock = threading.Lock()
+
+
+class BatchResult(NamedTuple):
+    "Outcome of writing one tick of comment records to the database."
+
+    inserted: int
+    duplicates: int
+    rejected: int
+    rows: List[Tuple[datetime, str]]  # (created_utc, author) of every inserted record
+
+
+def month_of(timestamp: datetime) -> date:
+    "The key of the month a timestamp falls in, as used by the scores table"
+
+    return timestamp.date().replace(day=1)
+
+
+def _next_month(month: date) -> date:
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def _unique(records: List[CommentRecord]) -> List[CommentRecord]:
+    "The same comment can show up twice in a stream drain; keep the first occurrence only"
+
+    seen = set()
+    unique_records = []
+    for record in records:
+        if record[0] not in seen:
+            seen.add(record[0])
+            unique_records.append(record)
+    return unique_records
+
+
+def _log_batch(result: BatchResult, total: int) -> None:
+    logging.info(
+        f"Wrote batch of {total} comments: {result.inserted} inserted, "
+        f"{result.duplicates} duplicates, {result.rejected} rejected"
+    )
+
+
+def _rank_cutoff(scores: List[Tuple[str, int]], k: int) -> List[Tuple[str, int]]:
+    """
+    Keep the (author, score) pairs, sorted by descending score, which score at least as much as the
+    k-th one
+    """
+
+    if len(scores) <= k:
+        return scores
+    cutoff = scores[k - 1][1]
+    return [(author, score) for author, score in scores if score >= cutoff]
+
+
+class Storage(ABC):
+    """
+    Interface shared by the Dojo storage backends.
+
+    Comments are stored as CommentRecords. Each backend also keeps a per-(month, author) score
+    table, which it updates in the same transaction as every insert or delete of comments. A backend
+    which does not implement every abstract method cannot be constructed.
+    """
+
+    name = "storage"
+
+    def ensure_schema(self) -> None:
+        "Create any missing tables and indexes. Safe to call on every startup."
+
+    @abstractmethod
+    def lookup_roots(
+        self, comment_ids: Iterable[str]
+    ) -> Dict[str, Tuple[str, Optional[str]]]:
+        "Returns: comment id -> (root_id, root_author) for the stored comments among comment_ids"
+
+    @abstractmethod
+    def insert_comments(self, records: List[CommentRecord]) -> BatchResult:
+        "Insert a tick of records, skipping duplicates and isolating records which cannot be stored"
+
+    @abstractmethod
+    def delete_comments(self, comment_ids: List[str]) -> List[Tuple[datetime, str]]:
+        "Returns: (created_utc, author) of every deleted comment"
+
+    @abstractmethod
+    def delete_older_than(self, cutoff: datetime) -> int:
+        """
+        Delete comments created before cutoff, along with their scores
+
+        Returns: the number of comments deleted
+        """
+
+    @abstractmethod
+    def comment_ids(self, start: datetime, end: datetime) -> List[str]:
+        "Returns: ids of the comments created in [start, end]"
+
+    @abstractmethod
+    def comments_by_author(
+        self, authors: List[str], start: datetime, end: datetime
+    ) -> Dict[str, List[str]]:
+        "Returns: author -> ids of their comments created in [start, end], oldest first"
+
+    @abstractmethod
+    def month_scores(self, month: date) -> Dict[str, int]:
+        "Returns: author -> score for every author with a score in the month"
+
+    @abstractmethod
+    def top_scores(self, month: date, k: int) -> List[Tuple[str, int]]:
+        """
+        Returns: (author, score) of every author scoring at least the k-th highest score of the
+        month, by descending score and then author. Deleted authors are left out.
+        """
+
+    @abstractmethod
+    def rebuild_scores(self, month: Optional[date] = None) -> int:
+        """
+        Reconstruct the scores of a month (or of every month) from the raw comments
+
+        Returns: the number of scores written
+        """
+
+    @abstractmethod
+    def get_state(self, key: str) -> Optional[str]:
+        "Returns: the value last stored under key, or None"
+
+    @abstractmethod
+    def set_state(self, key: str, value: str) -> None:
+        "Store value under key, replacing any earlier value"
+
+    @abstractmethod
+    def masters(self, current_only: bool = True) -> List[MasterRecord]:
+        """
+        Returns: every Dojo Master whose flair has not been revoked (or every Dojo Master ever
+        awarded), by month and then username
+        """
+
+    @abstractmethod
+    def record_masters(self, masters: List[MasterRecord]) -> None:
+        "Record users who were just awarded the Dojo Master flair, replacing an earlier award"
+
+    @abstractmethod
+    def revoke_masters(self, usernames: List[str]) -> int:
+        """
+        Mark the Dojo Master flairs of users as revoked
+
+        Returns: the number of flairs marked
+        """
+
+    def stats(self) -> Dict[str, float]:
+        "Backend-specific counters worth logging, e.g. connection pool statistics"
+        return {}
+
+
+class PostgresStorage(Storage):
+    "Stores the Dojo tables in Postgres, through the process-wide connection pool."
+
+    name = "postgres"
+
+    def __init__(
+        self,
+        table: str = TABLE_NAME,
+        scores_table: str = SCORES_TABLE_NAME,
+        batch: bool = BATCH_INGEST,
+        state_table: str = STATE_TABLE_NAME,
+        masters_table: str = MASTERS_TABLE_NAME,
+    ) -> None:
+        self.table = table
+        self.scores_table = scores_table
+        self.batch = batch
+        self.state_table = state_table
+        self.masters_table = masters_table
+
+    def stats(self) -> Dict[str, float]:
+        return db.pool_stats()
+
+    def _partition_name(self, month: date) -> str:
+        return f"{self.table}_y{month.year}m{month.month:02d}"
+
+    def _partitions(self, cur) -> List[Tuple[date, str]]:
+        "Returns: (month, partition name) of every monthly partition of the comments table"
+
+        cur.execute(
+            """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+        """,
+            (self.table,),
+        )
+        partitions = []
+        for (partition,) in cur.fetchall():
+            match = re.fullmatch(
+                rf"{re.escape(self.table)}_y(\d{{4}})m(\d{{2}})", partition
+            )
+            if match:
+                partitions.append(
+                    (date(int(match.group(1)), int(match.group(2)), 1), partition)
+                )
+        return sorted(partitions)
+
+    def _create_partitions(self, cur, first: date, last: date) -> None:
+        "Create the monthly partitions for every month in [first, last] which is missing"
+
+        month = first
+        while month <= last:
+            cur.execute(
+                sql.SQL(
+                    """
+            CREATE TABLE IF NOT EXISTS {} PARTITION OF {}
+            FOR VALUES FROM (%s) TO (%s)
+            """
+                ).format(
+                    sql.Identifier(self._partition_name(month)),
+                    sql.Identifier(self.table),
+                ),
+                (month, _next_month(month)),
+            )
+            month = _next_month(month)
+
+    def _migrate_legacy_table(self, cur) -> None:
+        """
+        Move the rows of an unpartitioned comments table (the schema this bot started out with) into
+        a freshly created partitioned one. The old table is dropped in the same transaction once its
+        rows are copied and the scores rebuilt, so that the rows are not stored twice.
+        """
+
+        legacy = f"{self.table}_legacy"
+        logging.warning(f"Migrating unpartitioned {self.table} into monthly partitions")
+        cur.execute(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                sql.Identifier(self.table), sql.Identifier(legacy)
+            )
+        )
+        # free up the primary key's name for the new table, if the old one had one
+        cur.execute(
+            sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+                sql.Identifier(f"{self.table}_pkey"), sql.Identifier(f"{legacy}_pkey")
+            )
+        )
+        cur.execute(
+            sql.SQL(
+                """
+        ALTER TABLE {}
+        ADD COLUMN IF NOT EXISTS root_id varchar,
+        ADD COLUMN IF NOT EXISTS root_author varchar
+        """
+            ).format(sql.Identifier(legacy))
+        )
+        self._create_tables(cur)
+        cur.execute(
+            sql.SQL("SELECT min(created_utc), max(created_utc) FROM {}").format(
+                sql.Identifier(legacy)
+            )
+        )
+        first, last = cur.fetchone()
+        legacy_rows = 0
+        if first is not None:
+            cur.execute(
+                sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(legacy))
+            )
+            (legacy_rows,) = cur.fetchone()
+            self._create_partitions(cur, month_of(first), month_of(last))
+            cur.execute(
+                sql.SQL(
+                    """
+            INSERT INTO {} (id, created_utc, author, root_id, root_author)
+            SELECT id, created_utc, COALESCE(author, %s), root_id, root_author
+            FROM {}
+            WHERE id IS NOT NULL AND created_utc IS NOT NULL
+            ON CONFLICT DO NOTHING
+            """
+                ).format(sql.Identifier(self.table), sql.Identifier(legacy)),
+                (DELETED_AUTHOR,),
+            )
+            logging.warning(
+                f"Migrated {cur.rowcount} of the {legacy_rows} rows of {legacy} "
+                "(duplicates and rows without an id or time are left out)"
+            )
+            rebuilt = self._rebuild_scores(cur)
+            logging.warning(f"Rebuilt {rebuilt} scores from the migrated comments")
+        # the copy is complete, keeping the old rows would only count against the database's row cap
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(legacy)))
+        logging.warning(f"Dropped {legacy} and its {legacy_rows} rows")
+
+    def _create_tables(self, cur) -> None:
+        # Unique constraints on a partitioned table must include the partition key, so comments are
+        # keyed by (id, created_utc). A comment's created_utc never changes, so this is just as
+        # strict as a key on id alone.
+        cur.execute(
+            sql.SQL(
+                """
+        CREATE TABLE IF NOT EXISTS {} (
+            id varchar NOT NULL,
+            created_utc timestamp NOT NULL,
+            author varchar NOT NULL,
+            root_id varchar,
+            root_author varchar,
+            PRIMARY KEY (id, created_utc)
+        ) PARTITION BY RANGE (created_utc);
+        CREATE INDEX IF NOT EXISTS {} ON {} (created_utc, author) INCLUDE (id);
+        CREATE TABLE IF NOT EXISTS {} (
+            month date NOT NULL,
+            author varchar NOT NULL,
+            score integer NOT NULL,
+            PRIMARY KEY (month, author)
+        );
+        CREATE INDEX IF NOT EXISTS {} ON {} (month, score DESC);
+        CREATE TABLE IF NOT EXISTS {} (
+            key varchar PRIMARY KEY,
+            value text NOT NULL,
+            updated_at timestamp NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS {} (
+            username varchar NOT NULL,
+            month date NOT NULL,
+            original_flair varchar,
+            awarded_at timestamp NOT NULL DEFAULT now(),
+            revoked_at timestamp,
+            PRIMARY KEY (username, month)
+        );
+        CREATE INDEX IF NOT EXISTS {} ON {} (month) WHERE revoked_at IS NULL;
+        """
+            ).format(
+                sql.Identifier(self.table),
+                sql.Identifier(f"{self.table}_created_utc_author"),
+                sql.Identifier(self.table),
+                sql.Identifier(self.scores_table),
+                sql.Identifier(f"{self.scores_table}_month_score_idx"),
+                sql.Identifier(self.scores_table),
+                sql.Identifier(self.state_table),
+                sql.Identifier(self.masters_table),
+                sql.Identifier(f"{self.masters_table}_current_idx"),
+                sql.Identifier(self.masters_table),
+            )
+        )
+
+    def ensure_schema(self) -> None:
+        """
+        Create the partitioned comments table and the scores table if they are missing, migrating an
+        unpartitioned comments table if one exists, and create the partitions from last month up to
+        PARTITIONS_AHEAD months ahead. The scores are rebuilt from the comments whenever the scores
+        table did not exist before, or the comments were migrated.
+        """
+
+        with db.cursor() as cur:
+            cur.execute(
+                "SELECT relkind FROM pg_class WHERE relname = %s AND relkind IN ('r', 'p')",
+                (self.table,),
+            )
+            existing = cur.fetchone()
+            cur.execute(
+                "SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'r'",
+                (self.scores_table,),
+            )
+            scores_missing = cur.fetchone() is None
+            if existing and existing[0] == "r":
+                self._migrate_legacy_table(cur)
+            else:
+                self._create_tables(cur)
+                if existing and scores_missing:
+                    # comments from before the scores table existed would otherwise not count
+                    cur.execute(
+                        sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(
+                            sql.Identifier(self.table)
+                        )
+                    )
+                    if cur.fetchone()[0]:
+                        rebuilt = self._rebuild_scores(cur)
+                        logging.warning(
+                            f"Created {self.scores_table}, rebuilt {rebuilt} scores from {self.table}"
+                        )
+            this_month = month_of(datetime.now())
+            first = (this_month - timedelta(days=1)).replace(day=1)
+            last = this_month
+            for _ in range(PARTITIONS_AHEAD):
+                last = _next_month(last)
+            self._create_partitions(cur, first, last)
+        logging.info(f"Ensured {self.table} partitions up to {last}")
+
+    def _apply_score_deltas(
+        self, cur, rows: List[Tuple[datetime, str]], sign: int
+    ) -> None:
+        """
+        Add (sign = 1) or subtract (sign = -1) one point per (created_utc, author) row from the
+        monthly scores table, in the transaction of the matching insert/delete.
+        """
+
+        deltas = Counter(
+            (month_of(created_utc), author) for created_utc, author in rows
+        )
+        if not deltas:
+            return
+        execute_values(
+            cur,
+            sql.SQL(
+                """
+        INSERT INTO {} (month, author, score)
+        VALUES %s
+        ON CONFLICT (month, author) DO UPDATE SET score = {}.score + EXCLUDED.score
+        """
+            )
+            .format(
+                sql.Identifier(self.scores_table), sql.Identifier(self.scores_table)
+            )
+            .as_string(cur),
+            [
+                (month, author, sign * delta)
+                for (month, author), delta in deltas.items()
+            ],
+            page_size=len(deltas),
+        )
+        if sign < 0:
+            cur.execute(
+                sql.SQL(
+                    """
+            DELETE FROM {}
+            WHERE month = ANY(%s) AND score <= 0
+            """
+                ).format(sql.Identifier(self.scores_table)),
+                (list({month for month, _ in deltas}),),
+            )
+        logging.debug(
+            f"Applied {sign * sum(deltas.values())} points to {len(deltas)} scores"
+        )
+
+    def lookup_roots(
+        self, comment_ids: Iterable[str]
+    ) -> Dict[str, Tuple[str, Optional[str]]]:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    """
+            SELECT id, root_id, root_author FROM {}
+            WHERE id = ANY(%s) AND root_id IS NOT NULL
+            """
+                ).format(sql.Identifier(self.table)),
+                (list(comment_ids),),
+            )
+            return {
+                comment_id: (root_id, root_author)
+                for comment_id, root_id, root_author in cur.fetchall()
+            }
+
+    def insert_comments_rowwise(self, records: List[CommentRecord]) -> BatchResult:
+        """
+        Insert records into the database with one INSERT statement per record.
+
+        Each record is inserted inside its own savepoint, so that a failing record is rejected
+        without undoing the records before it. Kept around as the baseline that the batched path is
+        benchmarked against.
+        """
+
+        with db.connection() as conn:
+            cur = conn.cursor()
+            inserted: List[Tuple[datetime, str]] = []
+            rejected = 0
+            for record in records:
+                cur.execute("SAVEPOINT dojo_row")
+                try:
+                    cur.execute(
+                        sql.SQL(
+                            """
+                    INSERT INTO {} (id, created_utc, author, root_id, root_author)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING created_utc, author
+                    """
+                        ).format(sql.Identifier(self.table)),
+                        record,
+                    )
+                    rows = cur.fetchall()
+                    self._apply_score_deltas(cur, rows, 1)
+                    cur.execute("RELEASE SAVEPOINT dojo_row")
+                    if not rows:
+                        logging.debug("Comment already exists in db!")
+                    else:
+                        logging.debug("Inserted comment into db")
+                    inserted += rows
+                except psycopg2.Error:
+                    logging.error(traceback.format_exc())
+                    cur.execute("ROLLBACK TO SAVEPOINT dojo_row")
+                    rejected += 1
+            cur.close()
+        return BatchResult(
+            len(inserted), len(records) - len(inserted) - rejected, rejected, inserted
+        )
+
+    def _insert_batch(
+        self, cur, records: List[CommentRecord]
+    ) -> Tuple[List[Tuple[datetime, str]], int]:
+        """
+        Insert records with a single multi-row statement inside a savepoint. If the statement fails,
+        the batch is split in half and each half retried, so that a bad record only costs O(log n)
+        extra statements and never takes the rest of the batch down with it.
+
+        Returns: ((created_utc, author) of each record inserted, # of records rejected)
+        """
+
+        cur.execute("SAVEPOINT dojo_batch")
+        try:
+            inserted = execute_values(
+                cur,
+                sql.SQL(
+                    """
+            INSERT INTO {} (id, created_utc, author, root_id, root_author)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING created_utc, author
+            """
+                )
+                .format(sql.Identifier(self.table))
+                .as_string(cur),
+                records,
+                page_size=len(records),
+                fetch=True,
+            )
+            cur.execute("RELEASE SAVEPOINT dojo_batch")
+            return inserted, 0
+        except psycopg2.Error:
+            cur.execute("ROLLBACK TO SAVEPOINT dojo_batch")
+            if len(records) == 1:
+                logging.error(f"Rejected comment record {records[0]}")
+                logging.error(traceback.format_exc())
+                return [], 1
+        mid = len(records) // 2
+        left = self._insert_batch(cur, records[:mid])
+        right = self._insert_batch(cur, records[mid:])
+        return left[0] + right[0], left[1] + right[1]
+
+    def insert_comments(self, records: List[CommentRecord]) -> BatchResult:
+        """
+        Insert a whole tick of records in a single round-trip, along with the matching increments to
+        the monthly scores.
+
+        Records which already exist are counted as duplicates; records the database refuses are
+        isolated and counted as rejected without discarding the rest of the batch.
+        """
+
+        if not self.batch:
+            return self.insert_comments_rowwise(records)
+        unique_records = _unique(records)
+        if not unique_records:
+            return BatchResult(0, 0, 0, [])
+
+        with db.cursor() as cur:
+            inserted, rejected = self._insert_batch(cur, unique_records)
+            self._apply_score_deltas(cur, inserted, 1)
+        result = BatchResult(
+            len(inserted), len(records) - len(inserted) - rejected, rejected, inserted
+        )
+        _log_batch(result, len(records))
+        return result
+
+    def delete_comments(self, comment_ids: List[str]) -> List[Tuple[datetime, str]]:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    """
+            DELETE FROM {}
+            WHERE id = ANY(%s)
+            RETURNING created_utc, author
+            """
+                ).format(sql.Identifier(self.table)),
+                (list(comment_ids),),
+            )
+            deleted = cur.fetchall()
+            self._apply_score_deltas(cur, deleted, -1)
+        return deleted
+
+    def delete_older_than(self, cutoff: datetime) -> int:
+        """
+        Drop every monthly partition which lies entirely before cutoff, along with the scores of
+        those months. Dropping a partition takes constant time however many rows it holds; rows in
+        the partition straddling cutoff are kept until it is dropped on a later run.
+
+        Returns: the planner's estimate of the number of comments deleted
+        """
+
+        deleted = 0
+        with db.cursor() as cur:
+            for month, partition in self._partitions(cur):
+                if _next_month(month) > cutoff.date():
+                    continue
+                cur.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    (partition,),
+                )
+                rows = max(cur.fetchone()[0], 0)
+                cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+                cur.execute(
+                    sql.SQL("DELETE FROM {} WHERE month = %s").format(
+                        sql.Identifier(self.scores_table)
+                    ),
+                    (month,),
+                )
+                logging.info(f"Dropped partition {partition} (~{rows} comments)")
+                deleted += rows
+        return deleted
+
+    def comment_ids(self, start: datetime, end: datetime) -> List[str]:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    """
+            SELECT id from {}
+            WHERE created_utc BETWEEN %s AND %s
+            """
+                ).format(sql.Identifier(self.table)),
+                (start, end),
+            )
+            return [record[0] for record in cur.fetchall()]
+
+    def comments_by_author(
+        self, authors: List[str], start: datetime, end: datetime
+    ) -> Dict[str, List[str]]:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    """
+            SELECT author, array_agg(id ORDER BY created_utc)
+            FROM {}
+            WHERE author = ANY(%s)
+            AND
+            created_utc BETWEEN %s AND %s
+            GROUP BY author
+            """
+                ).format(sql.Identifier(self.table)),
+                (list(authors), start, end),
+            )
+            return dict(cur.fetchall())
+
+    def month_scores(self, month: date) -> Dict[str, int]:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL("SELECT author, score FROM {} WHERE month = %s").format(
+                    sql.Identifier(self.scores_table)
+                ),
+                (month,),
+            )
+            return dict(cur.fetchall())
+
+    def top_scores(self, month: date, k: int) -> List[Tuple[str, int]]:
+        query = sql.SQL(
+            """
+        SELECT author, score
+        FROM {}
+        WHERE
+        month = %s
+        AND
+        author != %s
+        AND
+        score >= COALESCE(
+            (
+                SELECT score
+                FROM {}
+                WHERE month = %s AND author != %s
+                ORDER BY score DESC
+                OFFSET %s
+                LIMIT 1
+            ),
+            0
+        )
+        ORDER BY score DESC, author
+        """
+        ).format(sql.Identifier(self.scores_table), sql.Identifier(self.scores_table))
+        params = (month, DELETED_AUTHOR, month, DELETED_AUTHOR, k - 1)
+        with db.cursor() as cur:
+            logging.debug(cur.mogrify(query, params))
+            cur.execute(query, params)
+            return cur.fetchall()
+
+    def _rebuild_scores(self, cur, month: Optional[date] = None) -> int:
+        "rebuild_scores() in the transaction of cur"
+
+        if month is None:
+            cur.execute(
+                sql.SQL("DELETE FROM {}").format(sql.Identifier(self.scores_table))
+            )
+            cur.execute(
+                sql.SQL(
+                    """
+            INSERT INTO {} (month, author, score)
+            SELECT date_trunc('month', created_utc)::date, author, COUNT(*)
+            FROM {}
+            GROUP BY 1, 2
+            """
+                ).format(sql.Identifier(self.scores_table), sql.Identifier(self.table))
+            )
+        else:
+            cur.execute(
+                sql.SQL("DELETE FROM {} WHERE month = %s").format(
+                    sql.Identifier(self.scores_table)
+                ),
+                (month,),
+            )
+            cur.execute(
+                sql.SQL(
+                    """
+            INSERT INTO {} (month, author, score)
+            SELECT %s, author, COUNT(*)
+            FROM {}
+            WHERE created_utc >= %s AND created_utc < %s
+            GROUP BY author
+            """
+                ).format(sql.Identifier(self.scores_table), sql.Identifier(self.table)),
+                (month, month, _next_month(month)),
+            )
+        return cur.rowcount
+
+    def rebuild_scores(self, month: Optional[date] = None) -> int:
+        with db.cursor() as cur:
+            return self._rebuild_scores(cur, month)
+
+    def get_state(self, key: str) -> Optional[str]:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL("SELECT value FROM {} WHERE key = %s").format(
+                    sql.Identifier(self.state_table)
+                ),
+                (key,),
+            )
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: str) -> None:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    """
+            INSERT INTO {} (key, value) VALUES (%s, %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()
+            """
+                ).format(sql.Identifier(self.state_table)),
+                (key, value),
+            )
+
+    def masters(self, current_only: bool = True) -> List[MasterRecord]:
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    """
+            SELECT username, month, original_flair
+            FROM {}
+            {}
+            ORDER BY month, username
+            """
+                ).format(
+                    sql.Identifier(self.masters_table),
+                    sql.SQL("WHERE revoked_at IS NULL" if current_only else ""),
+                )
+            )
+            return [tuple(row) for row in cur.fetchall()]
+
+    def record_masters(self, masters: List[MasterRecord]) -> None:
+        if not masters:
+            return
+        with db.cursor() as cur:
+            execute_values(
+                cur,
+                sql.SQL(
+                    """
+            INSERT INTO {} (username, month, original_flair)
+            VALUES %s
+            ON CONFLICT (username, month) DO UPDATE
+            SET original_flair = EXCLUDED.original_flair, awarded_at = now(), revoked_at = NULL
+            """
+                )
+                .format(sql.Identifier(self.masters_table))
+                .as_string(cur),
+                masters,
+            )
+
+    def revoke_masters(self, usernames: List[str]) -> int:
+        if not usernames:
+            return 0
+        with db.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    """
+            UPDATE {} SET revoked_at = now()
+            WHERE username = ANY(%s) AND revoked_at IS NULL
+            """
+                ).format(sql.Identifier(self.masters_table)),
+                (list(usernames),),
+            )
+            return cur.rowcount
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores the Dojo tables in a local SQLite file in WAL mode, so that ingestion and tallying can be
+    run and load-tested on a small box without a Postgres server.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = SQLITE_PATH) -> None:
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self.ensure_schema()
+
+    def ensure_schema(self) -> None:
+        with self._lock:
+            self._conn.executescript(
+                f"""
+            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                id TEXT PRIMARY KEY,
+                created_utc TEXT NOT NULL,
+                author TEXT NOT NULL,
+                root_id TEXT,
+                root_author TEXT
+            );
+            CREATE INDEX IF NOT EXISTS {TABLE_NAME}_created_utc_author
+                ON {TABLE_NAME} (created_utc, author);
+            CREATE INDEX IF NOT EXISTS {TABLE_NAME}_author_created_utc
+                ON {TABLE_NAME} (author, created_utc);
+            CREATE TABLE IF NOT EXISTS {SCORES_TABLE_NAME} (
+                month TEXT NOT NULL,
+                author TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (month, author)
+            );
+            CREATE INDEX IF NOT EXISTS {SCORES_TABLE_NAME}_month_score
+                ON {SCORES_TABLE_NAME} (month, score DESC);
+            CREATE TABLE IF NOT EXISTS {STATE_TABLE_NAME} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS {MASTERS_TABLE_NAME} (
+                username TEXT NOT NULL,
+                month TEXT NOT NULL,
+                original_flair TEXT,
+                awarded_at TEXT NOT NULL,
+                revoked_at TEXT,
+                PRIMARY KEY (username, month)
+            );
+            """
+            )
+
+    @staticmethod
+    def _chunks(items: List[str]) -> Iterable[List[str]]:
+        for idx in range(0, len(items), SQLITE_MAX_VARIABLES):
+            yield items[idx : idx + SQLITE_MAX_VARIABLES]
+
+    def _apply_score_deltas(self, rows: List[Tuple[datetime, str]], sign: int) -> None:
+        "Must be called with self._lock held, inside the transaction of the insert/delete"
+
+        deltas = Counter(
+            (month_of(created_utc).isoformat(), author) for created_utc, author in rows
+        )
+        self._conn.executemany(
+            f"""
+        INSERT INTO {SCORES_TABLE_NAME} (month, author, score)
+        VALUES (?, ?, ?)
+        ON CONFLICT (month, author) DO UPDATE SET score = score + excluded.score
+        """,
+            [
+                (month, author, sign * delta)
+                for (month, author), delta in deltas.items()
+            ],
+        )
+        if sign < 0:
+            self._conn.execute(f"DELETE FROM {SCORES_TABLE_NAME} WHERE score <= 0")
+
+    def _select_deleted(self, where: str, params) -> List[Tuple[datetime, str]]:
+        rows = self._conn.execute(
+            f"SELECT created_utc, author FROM {TABLE_NAME} WHERE {where}", params
+        ).fetchall()
+        self._conn.execute(f"DELETE FROM {TABLE_NAME} WHERE {where}", params)
+        return [
+            (datetime.fromisoformat(created_utc), author)
+            for created_utc, author in rows
+        ]
+
+    def lookup_roots(
+        self, comment_ids: Iterable[str]
+    ) -> Dict[str, Tuple[str, Optional[str]]]:
+        roots: Dict[str, Tuple[str, Optional[str]]] = {}
+        with self._lock:
+            for chunk in self._chunks(list(comment_ids)):
+                for comment_id, root_id, root_author in self._conn.execute(
+                    f"""
+                SELECT id, root_id, root_author FROM {TABLE_NAME}
+                WHERE id IN ({", ".join("?" * len(chunk))}) AND root_id IS NOT NULL
+                """,
+                    chunk,
+                ):
+                    roots[comment_id] = (root_id, root_author)
+        return roots
+
+    def insert_comments(self, records: List[CommentRecord]) -> BatchResult:
+        unique_records = _unique(records)
+        if not unique_records:
+            return BatchResult(0, 0, 0, [])
+
+        inserted: List[Tuple[datetime, str]] = []
+        rejected = 0
+        with self._lock, self._conn:
+            existing = set()
+            for chunk in self._chunks([record[0] for record in unique_records]):
+                existing.update(
+                    row[0]
+                    for row in self._conn.execute(
+                        f"SELECT id FROM {TABLE_NAME} WHERE id IN ({', '.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+            new_records = [
+                record for record in unique_records if record[0] not in existing
+            ]
+            rows = [
+                (comment_id, created_utc.isoformat(" "), author, root_id, root_author)
+                for comment_id, created_utc, author, root_id, root_author in new_records
+            ]
+            insert = f"""
+            INSERT OR IGNORE INTO {TABLE_NAME} (id, created_utc, author, root_id, root_author)
+            VALUES (?, ?, ?, ?, ?)
+            """
+            try:
+                self._conn.executemany(insert, rows)
+                inserted = [(record[1], record[2]) for record in new_records]
+            except sqlite3.Error:
+                # Nothing but this statement has written in the transaction yet
+                self._conn.rollback()
+                for record, row in zip(new_records, rows):
+                    try:
+                        self._conn.execute(insert, row)
+                        inserted.append((record[1], record[2]))
+                    except sqlite3.Error:
+                        logging.error(f"Rejected comment record {record}")
+                        logging.error(traceback.format_exc())
+                        rejected += 1
+            self._apply_score_deltas(inserted, 1)
+        result = BatchResult(
+            len(inserted), len(records) - len(inserted) - rejected, rejected, inserted
+        )
+        _log_batch(result, len(records))
+        return result
+
+    def delete_comments(self, comment_ids: List[str]) -> List[Tuple[datetime, str]]:
+        deleted: List[Tuple[datetime, str]] = []
+        with self._lock, self._conn:
+            for chunk in self._chunks(list(comment_ids)):
+                deleted += self._select_deleted(
+                    f"id IN ({', '.join('?' * len(chunk))})", chunk
+                )
+            self._apply_score_deltas(deleted, -1)
+        return deleted
+
+    def delete_older_than(self, cutoff: datetime) -> int:
+        with self._lock, self._conn:
+            deleted = self._select_deleted("created_utc < ?", (cutoff.isoformat(" "),))
+            self._apply_score_deltas(deleted, -1)
+        return len(deleted)
+
+    def comment_ids(self, start: datetime, end: datetime) -> List[str]:
+        with self._lock:
+            return [
+                row[0]
+                for row in self._conn.execute(
+                    f"SELECT id FROM {TABLE_NAME} WHERE created_utc BETWEEN ? AND ?",
+                    (start.isoformat(" "), end.isoformat(" ")),
+                )
+            ]
+
+    def comments_by_author(
+        self, authors: List[str], start: datetime, end: datetime
+    ) -> Dict[str, List[str]]:
+        comments: Dict[str, List[str]] = {}
+        with self._lock:
+            for chunk in self._chunks(list(authors)):
+                for author, comment_id in self._conn.execute(
+                    f"""
+                SELECT author, id FROM {TABLE_NAME}
+                WHERE author IN ({", ".join("?" * len(chunk))})
+                AND created_utc BETWEEN ? AND ?
+                ORDER BY author, created_utc
+                """,
+                    [*chunk, start.isoformat(" "), end.isoformat(" ")],
+                ):
+                    comments.setdefault(author, []).append(comment_id)
+        return comments
+
+    def month_scores(self, month: date) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                self._conn.execute(
+                    f"SELECT author, score FROM {SCORES_TABLE_NAME} WHERE month = ?",
+                    (month.isoformat(),),
+                )
+            )
+
+    def top_scores(self, month: date, k: int) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self._conn.execute(
+                f"""
+            SELECT author, score
+            FROM {SCORES_TABLE_NAME}
+            WHERE month = :month AND author != :deleted
+            AND score >= COALESCE(
+                (
+                    SELECT score FROM {SCORES_TABLE_NAME}
+                    WHERE month = :month AND author != :deleted
+                    ORDER BY score DESC
+                    LIMIT 1 OFFSET :offset
+                ),
+                0
+            )
+            ORDER BY score DESC, author
+            """,
+                {
+                    "month": month.isoformat(),
+                    "deleted": DELETED_AUTHOR,
+                    "offset": k - 1,
+                },
+            ).fetchall()
+
+    def rebuild_scores(self, month: Optional[date] = None) -> int:
+        with self._lock, self._conn:
+            if month is None:
+                self._conn.execute(f"DELETE FROM {SCORES_TABLE_NAME}")
+                cur = self._conn.execute(
+                    f"""
+                INSERT INTO {SCORES_TABLE_NAME} (month, author, score)
+                SELECT substr(created_utc, 1, 8) || '01', author, COUNT(*)
+                FROM {TABLE_NAME}
+                GROUP BY 1, 2
+                """
+                )
+            else:
+                self._conn.execute(
+                    f"DELETE FROM {SCORES_TABLE_NAME} WHERE month = ?",
+                    (month.isoformat(),),
+                )
+                cur = self._conn.execute(
+                    f"""
+                INSERT INTO {SCORES_TABLE_NAME} (month, author, score)
+                SELECT ?, author, COUNT(*)
+                FROM {TABLE_NAME}
+                WHERE created_utc >= ? AND created_utc < ?
+                GROUP BY author
+                """,
+                    (
+                        month.isoformat(),
+                        month.isoformat(),
+                        _next_month(month).isoformat(),
+                    ),
+                )
+            return cur.rowcount
+
+    def get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value FROM {STATE_TABLE_NAME} WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {STATE_TABLE_NAME} (key, value) VALUES (?, ?)",
+                (key, value),
+            )
+
+    def masters(self, current_only: bool = True) -> List[MasterRecord]:
+        where = "WHERE revoked_at IS NULL" if current_only else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"""
+            SELECT username, month, original_flair
+            FROM {MASTERS_TABLE_NAME}
+            {where}
+            ORDER BY month, username
+            """
+            ).fetchall()
+        return [
+            (username, date.fromisoformat(month), original_flair)
+            for username, month, original_flair in rows
+        ]
+
+    def record_masters(self, masters: List[MasterRecord]) -> None:
+        awarded_at = datetime.now().isoformat(sep=" ")
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"""
+            INSERT OR REPLACE INTO {MASTERS_TABLE_NAME}
+                (username, month, original_flair, awarded_at, revoked_at)
+            VALUES (?, ?, ?, ?, NULL)
+            """,
+                [
+                    (username, month.isoformat(), original_flair, awarded_at)
+                    for username, month, original_flair in masters
+                ],
+            )
+
+    def revoke_masters(self, usernames: List[str]) -> int:
+        revoked_at = datetime.now().isoformat(sep=" ")
+        revoked = 0
+        with self._lock, self._conn:
+            for chunk in self._chunks(list(usernames)):
+                cur = self._conn.execute(
+                    f"""
+                UPDATE {MASTERS_TABLE_NAME} SET revoked_at = ?
+                WHERE revoked_at IS NULL AND username IN ({", ".join("?" * len(chunk))})
+                """,
+                    [revoked_at, *chunk],
+                )
+                revoked += cur.rowcount
+        return revoked
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps the Dojo tables in dictionaries. Nothing survives a restart; meant for local runs and
+    benchmarks.
+    """
+
+    name = "memory"
+
+    def __init__(self) -> None:
+        self._comments: Dict[str, CommentRecord] = {}
+        self._scores: Counter = Counter()  # (month, author) -> score
+        self._state: Dict[str, str] = {}
+        # (username, month) -> (original flair, awarded at, revoked at)
+        self._masters: Dict[
+            Tuple[str, date], Tuple[Optional[str], datetime, Optional[datetime]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def _apply_score_deltas(self, rows: List[Tuple[datetime, str]], sign: int) -> None:
+        for created_utc, author in rows:
+            key = (month_of(created_utc), author)
+            self._scores[key] += sign
+            if self._scores[key] <= 0:
+                del self._scores[key]
+
+    def _delete(self, comment_ids: Iterable[str]) -> List[Tuple[datetime, str]]:
+        deleted = []
+        for comment_id in comment_ids:
+            record = self._comments.pop(comment_id, None)
+            if record is not None:
+                deleted.append((record[1], record[2]))
+        self._apply_score_deltas(deleted, -1)
+        return deleted
+
+    def lookup_roots(
+        self, comment_ids: Iterable[str]
+    ) -> Dict[str, Tuple[str, Optional[str]]]:
+        with self._lock:
+            return {
+                comment_id: self._comments[comment_id][3:]
+                for comment_id in comment_ids
+                if comment_id in self._comments
+                and self._comments[comment_id][3] is not None
+            }
+
+    def insert_comments(self, records: List[CommentRecord]) -> BatchResult:
+        inserted: List[Tuple[datetime, str]] = []
+        with self._lock:
+            for record in _unique(records):
+                if record[0] not in self._comments:
+                    self._comments[record[0]] = record
+                    inserted.append((record[1], record[2]))
+            self._apply_score_deltas(inserted, 1)
+        result = BatchResult(len(inserted), len(records) - len(inserted), 0, inserted)
+        _log_batch(result, len(records))
+        return result
+
+    def delete_comments(self, comment_ids: List[str]) -> List[Tuple[datetime, str]]:
+        with self._lock:
+            return self._delete(comment_ids)
+
+    def delete_older_than(self, cutoff: datetime) -> int:
+        with self._lock:
+            deleted = self._delete(
+                [record[0] for record in self._comments.values() if record[1] < cutoff]
+            )
+        return len(deleted)
+
+    def comment_ids(self, start: datetime, end: datetime) -> List[str]:
+        with self._lock:
+            return [
+                record[0]
+                for record in self._comments.values()
+                if start <= record[1] <= end
+            ]
+
+    def comments_by_author(
+        self, authors: List[str], start: datetime, end: datetime
+    ) -> Dict[str, List[str]]:
+        wanted = set(authors)
+        with self._lock:
+            records = sorted(
+                (
+                    record
+                    for record in self._comments.values()
+                    if record[2] in wanted and start <= record[1] <= end
+                ),
+                key=lambda record: record[1],
+            )
+        comments: Dict[str, List[str]] = {}
+        for record in records:
+            comments.setdefault(record[2], []).append(record[0])
+        return comments
+
+    def month_scores(self, month: date) -> Dict[str, int]:
+        with self._lock:
+            return {
+                author: score
+                for (score_month, author), score in self._scores.items()
+                if score_month == month
+            }
+
+    def top_scores(self, month: date, k: int) -> List[Tuple[str, int]]:
+        scores = sorted(
+            (
+                (author, score)
+                for author, score in self.month_scores(month).items()
+                if author != DELETED_AUTHOR
+            ),
+            key=lambda entry: (-entry[1], entry[0]),
+        )
+        return _rank_cutoff(scores, k)
+
+    def rebuild_scores(self, month: Optional[date] = None) -> int:
+        with self._lock:
+            rebuilt = Counter(
+                (month_of(record[1]), record[2])
+                for record in self._comments.values()
+                if month is None or month_of(record[1]) == month
+            )
+            if month is None:
+                self._scores = rebuilt
+            else:
+                for key in [key for key in self._scores if key[0] == month]:
+                    del self._scores[key]
+                self._scores.update(rebuilt)
+            return len(rebuilt)
+
+    def get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._state.get(key)
+
+    def set_state(self, key: str, value: str) -> None:
+        with self._lock:
+            self._state[key] = value
+
+    def masters(self, current_only: bool = True) -> List[MasterRecord]:
+        with self._lock:
+            return [
+                (username, month, original_flair)
+                for (username, month), (original_flair, _, revoked_at) in sorted(
+                    self._masters.items(), key=lambda item: (item[0][1], item[0][0])
+                )
+                if not current_only or revoked_at is None
+            ]
+
+    def record_masters(self, masters: List[MasterRecord]) -> None:
+        awarded_at = datetime.now()
+        with self._lock:
+            for username, month, original_flair in masters:
+                self._masters[(username, month)] = (original_flair, awarded_at, None)
+
+    def revoke_masters(self, usernames: List[str]) -> int:
+        revoked_at = datetime.now()
+        usernames = set(usernames)
+        revoked = 0
+        with self._lock:
+            for (username, month), master in self._masters.items():
+                if username in usernames and master[2] is None:
+                    self._masters[(username, month)] = (
+                        master[0],
+                        master[1],
+                        revoked_at,
+                    )
+                    revoked += 1
+        return revoked
+
+
+def create_storage(name: str) -> Storage:
+    "Create the storage backend called name ('postgres', 'sqlite' or 'memory')"
+
+    if name == PostgresStorage.name:
+        return PostgresStorage()
+    if name == SQLiteStorage.name:
+        return SQLiteStorage(os.environ.get("DOJO_SQLITE_PATH", SQLITE_PATH))
+    if name == MemoryStorage.name:
+        return MemoryStorage()
+    raise ValueError(f"Unknown Dojo storage backend '{name}'")
+
+
+def get_storage() -> Storage:
+    "Returns the process-wide storage backend, picked by DOJO_STORAGE (default: postgres)"
+
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = create_storage(
+                os.environ.get("DOJO_STORAGE", PostgresStorage.name)
+            )
+            logging.info(f"Using {_storage.name} storage for the Dojo")
+        return _storage
+
+
+def set_storage(storage: Storage) -> None:
+    "Replace the process-wide storage backend, e.g. with a MemoryStorage in benchmarks"
+
+    global _storage
+    with _storage_lock:
+        _storage = storage
@@ -0,0 +1,373 @@
+"""
+Polls each subreddit listing (comments, submissions) from a single background thread and fans every
+new item out to the consumers subscribed to it, so that one API request serves every task which
+reads the listing.
+
+A consumer is a bounded queue which can be drained like the PRAW stream it replaces -
+
+    while comment := next(consumer):
+        ...
+
+next() returns None once the queue is empty, the same as a PRAW stream created with pause_after=0.
+Consumers call commit() once they have dealt with the items they drained.
+
+The newest item every consumer has committed is checkpointed in storage. On startup the items
+made since the checkpoint (e.g. while the bot was restarting) are read from the listing in pages of
+100 and handed to the consumers before live polling starts.
+"""
+
+import json
+import logging
+import queue
+import threading
+import traceback
+from collections import deque
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import budget
+import cache
+import storage
+
+STREAM_QUEUE_SIZE: int = (
+    10000  # items buffered per consumer before the oldest are dropped
+)
+POLL_INTERVAL: float = 15.0  # seconds between polls once a listing has no new items
+ERROR_BACKOFF: float = 60.0  # seconds to wait before reopening a listing which raised
+BACKFILL_LIMIT: int = (
+    1000  # most items read on startup, Reddit's listings go no further back
+)
+SEEN_CACHE_SIZE: int = 2000  # recent fullnames remembered to drop items read twice
+
+
+class Consumer:
+    """
+    The items of a listing delivered to one consumer, optionally only those for which accept
+    returns True. Iterating never blocks: next() returns None when there is nothing new.
+
+    Once the items handed out have been dealt with (e.g. written to the db), the consumer calls
+    commit(), which is what lets the stream checkpoint move forward. Items which were handed out
+    but not committed by the time the next drain starts are handed out again first, so a failed
+    write is retried on the next tick and a restart backfills them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = STREAM_QUEUE_SIZE,
+        accept: Callable[[object], bool] = None,
+    ) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.accept = accept
+        self._queue: "queue.Queue[Tuple[int, object]]" = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._offered = 0  # sequence number of the last item offered
+        self._drained = (
+            0  # sequence number of the last item offered when next() returned None
+        )
+        self._exhausted = (
+            False  # next() returned None since the last item was handed out
+        )
+        self._unacked: List[Tuple[int, object]] = []  # handed out, not committed yet
+        self._redeliver: "deque[Tuple[int, object]]" = deque()
+        self.processed = 0  # sequence number up to which every item was committed
+        self.delivered = 0
+        self.dropped = 0
+        self.redelivered = 0
+
+    def offer(self, item, seq: int = 0) -> None:
+        "Queue the item if the consumer accepts it, dropping the oldest item if the queue is full"
+
+        try:
+            accepted = self.accept is None or self.accept(item)
+        except Exception:
+            logging.error(traceback.format_exc())
+            accepted = False
+        with self._lock:
+            self._offered = seq
+            if not accepted:
+                if self._queue.empty() and not self._unacked and not self._redeliver:
+                    self.processed = seq
+                return
+            while True:
+                try:
+                    self._queue.put_nowait((seq, item))
+                    self.delivered += 1
+                    return
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                    except queue.Empty:
+                        pass
+                    self.dropped += 1
+                    logging.error(
+                        f"Consumer {self.name} is full, dropped its oldest item"
+                    )
+
+    def __iter__(self) -> "Consumer":
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if self._exhausted:
+                # a new drain without a commit since the last one, start with the uncommitted items
+                self._exhausted = False
+                if self._unacked:
+                    overflow = len(self._unacked) - self.maxsize
+                    if overflow > 0:
+                        self.dropped += overflow
+                        logging.error(
+                            f"Consumer {self.name} dropped {overflow} uncommitted items"
+                        )
+                        del self._unacked[:overflow]
+                    self._redeliver.extend(self._unacked)
+                    self.redelivered += len(self._unacked)
+                    logging.warning(
+                        f"Handing out {len(self._unacked)} uncommitted items of {self.name} again"
+                    )
+                    self._unacked = []
+            if self._redeliver:
+                entry = self._redeliver.popleft()
+            else:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    self._drained = self._offered
+                    self._exhausted = True
+                    return None
+            self._unacked.append(entry)
+            return entry[1]
+
+    def commit(self) -> None:
+        "Acknowledge every item handed out so far, letting the checkpoint move past them"
+
+        with self._lock:
+            if self._unacked:
+                self.processed = max(self.processed, self._unacked[-1][0])
+                self._unacked = []
+            if self._exhausted and not self._redeliver:
+                self.processed = max(self.processed, self._drained)
+
+    def __len__(self) -> int:
+        return self._queue.qsize() + len(self._redeliver)
+
+
+def commit(stream) -> None:
+    "Acknowledge the items drained from a Consumer. A plain PRAW stream has nothing to acknowledge."
+
+    if isinstance(stream, Consumer):
+        stream.commit()
+
+
+class StreamMultiplexer:
+    """
+    Reads a listing through PRAW streams made by open_stream(skip_existing) (which must use
+    pause_after=0) and hands every item to each subscribed consumer. The stream is reopened if it
+    raises, since a generator which raised can not be resumed.
+
+    If listing(limit) is given, e.g. subreddit.comments, backfill() reads everything made since the
+    checkpoint stored under checkpoint:<name> before live polling starts.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        open_stream: Callable[[bool], Iterator],
+        listing: Callable[..., Iterator] = None,
+    ) -> None:
+        self.name = name
+        self.open_stream = open_stream
+        self.listing = listing
+        self._stream: Optional[Iterator] = None
+        self._consumers: List[Consumer] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._seq = 0
+        # seq -> (fullname, created_utc) of the items which are not checkpointed yet
+        self._pending: Dict[int, Tuple[str, float]] = {}
+        self._seen = cache.LRUCache(SEEN_CACHE_SIZE)
+        self._floor = (
+            0.0  # items made before this (the checkpoint) were handled before a restart
+        )
+        self._checkpoint: Optional[Tuple[str, float]] = None
+        self.polls = 0
+        self.items = 0
+        self.errors = 0
+        self.backfilled = 0
+
+    def subscribe(
+        self,
+        name: str,
+        maxsize: int = STREAM_QUEUE_SIZE,
+        accept: Callable[[object], bool] = None,
+    ) -> Consumer:
+        "Returns: a new consumer receiving every item read from now on"
+
+        consumer = Consumer(name, maxsize, accept)
+        with self._lock:
+            self._consumers.append(consumer)
+        return consumer
+
+    def publish(self, item) -> bool:
+        """
+        Hand an item to every consumer, unless it was already handed out or predates the checkpoint
+
+        Returns: True if the item was new
+        """
+
+        if item.fullname in self._seen or item.created_utc < self._floor:
+            return False
+        self._seen.put(item.fullname, True)
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._pending[seq] = (item.fullname, item.created_utc)
+            consumers = list(self._consumers)
+        for consumer in consumers:
+            consumer.offer(item, seq)
+        self.items += 1
+        return True
+
+    def _checkpoint_key(self) -> str:
+        return f"checkpoint:{self.name}"
+
+    def load_checkpoint(self) -> Optional[Tuple[str, float]]:
+        "Returns: the (fullname, created_utc) of the last item processed before a restart"
+
+        try:
+            value = storage.get_storage().get_state(self._checkpoint_key())
+        except Exception:
+            logging.error(traceback.format_exc())
+            return None
+        if value is None:
+            return None
+        checkpoint = json.loads(value)
+        return checkpoint["fullname"], checkpoint["created_utc"]
+
+    def save_checkpoint(self) -> None:
+        "Store the newest item which every consumer has committed, if it moved forward"
+
+        with self._lock:
+            done = min(
+                (consumer.processed for consumer in self._consumers),
+                default=self._seq,
+            )
+            done_seqs = [seq for seq in self._pending if seq <= done]
+            if not done_seqs:
+                return
+            checkpoint = self._pending[max(done_seqs)]
+            for seq in done_seqs:
+                del self._pending[seq]
+        if checkpoint == self._checkpoint:
+            return
+        try:
+            storage.get_storage().set_state(
+                self._checkpoint_key(),
+                json.dumps({"fullname": checkpoint[0], "created_utc": checkpoint[1]}),
+            )
+            self._checkpoint = checkpoint
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def backfill(self) -> int:
+        """
+        Hand the consumers every item made since the stored checkpoint, oldest first, reading the
+        listing newest first until the checkpoint is reached
+
+        Returns: the number of items backfilled
+        """
+
+        checkpoint = self.load_checkpoint()
+        if checkpoint is None or self.listing is None:
+            return 0
+        fullname, created_utc = checkpoint
+        self._floor = created_utc
+        self._checkpoint = checkpoint
+        self._seen.put(fullname, True)
+
+        missed = []
+        for item in self.listing(limit=BACKFILL_LIMIT):
+            if item.fullname == fullname or item.created_utc < created_utc:
+                break
+            missed.append(item)
+        else:
+            if missed:
+                logging.warning(
+                    f"Reached the end of the {self.name} listing before the checkpoint, "
+                    "some items may have been missed"
+                )
+        for item in reversed(missed):
+            self.publish(item)
+        self.backfilled += len(missed)
+        logging.info(f"Backfilled {len(missed)} {self.name} since {fullname}")
+        return len(missed)
+
+    def poll(self) -> int:
+        """
+        Read every new item of the listing and hand it to the consumers
+
+        Returns: the number of new items read
+        """
+
+        if self._stream is None:
+            # Without a checkpoint there is nothing to catch up on, otherwise read the listing's
+            # existing items too and let publish() drop those which were already handed out
+            self._stream = self.open_stream(self._checkpoint is None)
+        self.polls += 1
+        count = 0
+        try:
+            while item := next(self._stream):
+                count += self.publish(item)
+        except StopIteration:
+            self._stream = None
+        except Exception:
+            self.errors += 1
+            self._stream = None
+            raise
+        if count:
+            logging.debug(f"Read {count} new items from the {self.name} stream")
+        return count
+
+    def _run(self, interval: float) -> None:
+        with budget.task(f"{self.name}_stream"):
+            try:
+                self.backfill()
+            except Exception:
+                logging.error(traceback.format_exc())
+            while not self._stop.is_set():
+                try:
+                    self.save_checkpoint()
+                    self.poll()
+                    self._stop.wait(interval)
+                except Exception:
+                    logging.error(traceback.format_exc())
+                    self._stop.wait(ERROR_BACKOFF)
+
+    def start(self, interval: float = POLL_INTERVAL) -> threading.Thread:
+        "Backfill, then poll the listing every interval seconds, on a daemon thread"
+
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name=f"{self.name}-stream", daemon=True
+        )
+        self._thread.start()
+        return self._thread
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, float]:
+        "Returns: poll, item and error counts, and every consumer's backlog and drops"
+
+        stats: Dict[str, float] = {
+            "polls": self.polls,
+            "items": self.items,
+            "errors": self.errors,
+            "backfilled": self.backfilled,
+        }
+        with self._lock:
+            for consumer in self._consumers:
+                stats[f"{consumer.name}.backlog"] = len(consumer)
+                stats[f"{consumer.name}.dropped"] = consumer.dropped
+                stats[f"{consumer.name}.redelivered"] = consumer.redelivered
+        return stats
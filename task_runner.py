@@ -1,3 +1,4 @@
+import argparse
 import logging
 import os
 import time
@@ -5,13 +6,19 @@ import time
 import praw
 import schedule
 
+import budget
+import dojo
+import executor
+import metrics
+import replay
+import streams
 import tasks
 
 r = None
 
-logging.basicConfig(
-    format="[%(asctime)s] %(levelname)s:%(message)s", level=logging.ERROR
-)
+LOG_LEVEL: str = os.environ.get("LOG_LEVEL", "INFO")  # e.g. ERROR for a quieter log
+
+logging.basicConfig(format="[%(asctime)s] %(levelname)s:%(message)s", level=LOG_LEVEL)
 
 
 def login() -> int:
@@ -23,6 +30,7 @@ def login() -> int:
         password=os.environ["PASSWORD"],
         user_agent="u/tekken-bot by u/pisciatore",
         username=os.environ["BOT_USERNAME"],
+        requestor_kwargs={"session": budget.get_session()},
     )
     try:
         logging.debug(r.user.me())
@@ -34,33 +42,169 @@ def login() -> int:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the r/Tekken bot's tasks")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--record", metavar="CAPTURE", help="record Reddit and Twitch responses"
+    )
+    mode.add_argument(
+        "--replay",
+        metavar="CAPTURE",
+        help="run against a recorded capture instead of the network",
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="replay speed (default: 1x)"
+    )
+    args = parser.parse_args()
+
+    writer = player = None
+    if args.record:
+        writer = replay.record(args.record)
+    elif args.replay:
+        # the credentials are not sent anywhere, and tokens in the capture are redacted
+        for name in ("CLIENT_ID", "CLIENT_SECRET", "PASSWORD", "BOT_USERNAME"):
+            os.environ.setdefault(name, "replay")
+        player = replay.replay(args.replay, args.speed)
+
     logging.debug("Attempting to login...")
     if login():
         logging.error("Exiting application...")
         exit(1)
 
+    metrics.start_server()
+
+    # creates the tables the stream checkpoints are kept in
+    tasks.dojo_maintenance()
+
     tekken = r.subreddit("Tekken")
-    tekken_comment_stream = tekken.stream.comments(skip_existing=True, pause_after=0)
-    tekken_submission_stream = tekken.stream.submissions(
-        skip_existing=True, pause_after=0
+    # one poller per listing, shared by every task which reads it
+    tekken_comments = streams.StreamMultiplexer(
+        "comments",
+        lambda skip_existing: tekken.stream.comments(
+            skip_existing=skip_existing, pause_after=0
+        ),
+        listing=tekken.comments,
+    )
+    tekken_submissions = streams.StreamMultiplexer(
+        "submissions",
+        lambda skip_existing: tekken.stream.submissions(
+            skip_existing=skip_existing, pause_after=0
+        ),
+        listing=tekken.new,
     )
+    tekken_comment_stream = tekken_comments.subscribe(
+        "dojo", accept=dojo.is_dojo_comment
+    )
+    tekken_submission_stream = tekken_submissions.subscribe("moderation")
+    poll_interval = streams.POLL_INTERVAL / (args.speed if player else 1.0)
+    tekken_comments.start(poll_interval)
+    tekken_submissions.start(poll_interval)
 
     logging.info("Starting tasks...")
 
-    schedule.every(30).seconds.do(tasks.update_livestream_widget, subreddit=tekken)
+    budget.TASK_PRIORITIES.update(
+        {
+            "comments_stream": budget.MODERATION,
+            "submissions_stream": budget.MODERATION,
+            "shitposts": budget.MODERATION,
+            "dojo_leaderboard": budget.DOJO,
+            "dojo_reconcile": budget.DOJO,
+            "dojo_award": budget.DOJO,
+            "dojo_maintenance": budget.DOJO,
+            "dojo_cleaner": budget.DOJO,
+            "livestream": budget.COSMETIC,
+            "sidebar": budget.COSMETIC,
+            "events": budget.COSMETIC,
+            "dojo_links": budget.COSMETIC,
+        }
+    )
+    runner = executor.TaskExecutor()
+    schedule.every(30).seconds.do(
+        runner.submit,
+        "livestream",
+        tasks.update_livestream_widget,
+        subreddit=tekken,
+        timeout=25,
+        jitter=5,
+    )
     schedule.every(30).seconds.do(
-        tasks.delete_shitposts, subreddit=tekken, stream=tekken_submission_stream, day=5
+        runner.submit,
+        "shitposts",
+        tasks.delete_shitposts,
+        subreddit=tekken,
+        stream=tekken_submission_stream,
+        day=5,
+        timeout=25,
+    )
+    schedule.every(60).seconds.do(
+        runner.submit,
+        "dojo_leaderboard",
+        tasks.dojo_leaderboard,
+        subreddit=tekken,
+        stream=tekken_comment_stream,
+        timeout=50,
+        policy=executor.COALESCE,
     )
     schedule.every(60).seconds.do(
-        tasks.dojo_leaderboard, subreddit=tekken, stream=tekken_comment_stream
+        runner.submit, "sidebar", tasks.flush_sidebar, subreddit=tekken, timeout=50
+    )
+    schedule.every(30).minutes.do(
+        runner.submit, "events", tasks.update_events, subreddit=tekken, jitter=30
+    )
+    schedule.every(30).minutes.do(
+        runner.submit, "dojo_reconcile", tasks.dojo_reconcile, jitter=30
     )
-    schedule.every(30).minutes.do(tasks.update_events, subreddit=tekken)
     schedule.every(1).day.at("00:00:00").do(
-        tasks.dojo_award, reddit=r, subreddit=tekken
+        runner.submit,
+        "dojo_award",
+        tasks.dojo_award,
+        reddit=r,
+        subreddit=tekken,
+        timeout=3600,
+        policy=executor.COALESCE,
+    )
+    schedule.every(1).day.at("12:00:00").do(
+        runner.submit, "dojo_maintenance", tasks.dojo_maintenance, timeout=600
     )
-    schedule.every(20).weeks.do(tasks.dojo_cleaner)
-    schedule.every(4).weeks.do(tasks.update_dojo_links, subreddit=tekken)
+    schedule.every(20).weeks.do(
+        runner.submit, "dojo_cleaner", tasks.dojo_cleaner, timeout=3600
+    )
+    schedule.every(4).weeks.do(
+        runner.submit, "dojo_links", tasks.update_dojo_links, subreddit=tekken
+    )
+    schedule.every(1).hour.do(lambda: logging.info(f"Task stats: {runner.stats()}"))
+    schedule.every(1).hour.do(lambda: logging.info(f"Reddit quota: {budget.stats()}"))
+    schedule.every(1).hour.do(metrics.log_summary)
+    schedule.every(1).hour.do(
+        lambda: logging.info(
+            f"Stream stats: {tekken_comments.stats()}, {tekken_submissions.stats()}"
+        )
+    )
+
+    if writer:
+        schedule.every(1).minutes.do(writer.flush)
+
+    tick = 1.0 / args.speed if player else 1.0
+    last = time.monotonic()
+    try:
+        while player is None or not player.finished():
+            schedule.run_pending()
+            runner.check_timeouts()
+            time.sleep(tick)
+            if player:
+                now = time.monotonic()
+                replay.accelerate_schedule(schedule.jobs, now - last, args.speed)
+                last = now
+    finally:
+        if writer:
+            writer.close()
+            logging.info(f"Recorded {writer.records} responses to {args.record}")
 
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    # the replay has ended, report how the tasks fared against it
+    tekken_comments.stop()
+    tekken_submissions.stop()
+    runner.shutdown()
+    print(f"Replayed {args.replay} at {args.speed}x: {player.stats()}")
+    print(f"Task stats: {runner.stats()}")
+    print(f"Reddit quota: {budget.stats()}")
+    print(f"Metrics summary -\n{metrics.summary()}")
@@ -1,18 +1,19 @@
 "A collection of regularly scheduled miscellaneus tasks which don't require a separate module."
 
 import calendar
-import itertools
 import logging
 import re
 import time
 import traceback
 from datetime import datetime, timedelta
+from typing import Optional
 
 import praw
-import psycopg2
 
 import dojo
 import redesign
+import rules
+import storage
 import twitch
 
 SHITPOST_FLAIR_TEXT = "Shit Post"  # text of the shitpost flair
@@ -21,60 +22,39 @@ MAX_STATUS_LENGTH = 20  # length of status allowed in livestream table
 # e.g. 'LMFAOOOOOOoOoOoOoOoOoOoO' takes up the entire table width on my screen
 MAX_NUM_STREAMS = 5  # number of streams displayed in livestream table
 
-
-def get_removal_reason(subreddit):
-    for removal_reason in subreddit.mod.removal_reasons:
-        if removal_reason.title == "Off-schedule shitpost":
-            return removal_reason
+_rules: Optional[rules.RuleEngine] = None  # loaded on first use
 
 
 def delete_shitposts(subreddit, stream, flair_text=SHITPOST_FLAIR_TEXT, day=5):
     """
-    Deletes all posts not posted on the scheduled day whose flair text is 'flair_text'.
+    Moderates all new submissions with the rules of the moderation config in a single pass. By
+    default (and if there is no config) this deletes all posts not posted on the scheduled day whose
+    flair text is 'flair_text'.
 
     Parameters:
         subreddit - the subreddit to make changes in
-        day - the day of the week [1, 7] designated for posts with the given flair text
+        day - the day of the week [1, 7] designated for posts with the given flair text, if there
+            is no moderation config
     """
-    if day not in range(1, 8):
-        logging.warning(f"Invalid day of week ({day}). Setting day to Fri (5) instead.")
-        day = 5
-    logging.debug(f"Deleting posts with flair: {flair_text}")
-    while submission := next(stream):
-        logging.debug(submission.title)
-        if submission.link_flair_text == flair_text:
-            logging.debug(f"Submission flair matches {flair_text}!")
-            # Check timestamp if it is lies on the given day for all timezones in [-12:00, +14:00]
-            timestamp = datetime.fromtimestamp(int(submission.created_utc))
-            lies_on_day = False
-            for hours, mins in (
-                [(-12, 0)]
-                + list(itertools.product(range(-11, 14), (0, 30)))
-                + [(14, 0)]
-            ):
-                delta = timedelta(hours=hours, minutes=mins)
-                new_dt = timestamp + delta
-                if new_dt.isoweekday() == day:
-                    logging.debug(f"Lies on {day} with delta {delta}")
-                    lies_on_day = True
-                    break
-            if not lies_on_day:
-                # delete post
-                logging.info(
-                    f"Deleting post: https://www.reddit.com{submission.permalink}"
-                )
-                logging.debug("Getting removal reason for shitpost deletion")
-                removal_reason = get_removal_reason(subreddit)
-                logging.debug(
-                    f"Removing post with removal reason id {removal_reason.id}"
-                )
-                submission.mod.remove(reason_id=removal_reason.id)
-                logging.debug(f"Sending removal message {removal_reason.message}")
-                submission.mod.send_removal_message(
-                    removal_reason.message, type="public"
-                )
-            else:
-                logging.debug(f"Does not lie on {day}, no action")
+    global _rules
+    if _rules is None:
+        if day not in range(1, 8):
+            logging.warning(
+                f"Invalid day of week ({day}). Setting day to Fri (5) instead."
+            )
+            day = 5
+        shitpost_rule = rules.Rule(
+            "Off-schedule shitpost",
+            "remove",
+            flair=flair_text,
+            days=[day],
+            removal_reason="Off-schedule shitpost",
+        )
+        _rules = rules.load_engine(default_rules=[shitpost_rule])
+
+    acted_on = _rules.run(subreddit, stream)
+    if acted_on:
+        logging.info(f"Moderated {acted_on} submissions")
 
 
 def update_livestream_widget(subreddit) -> None:
@@ -91,16 +71,26 @@ def update_livestream_widget(subreddit) -> None:
     redesign.update_sidebar_old(subreddit, "Livestreams", text)
 
 
+def flush_sidebar(subreddit) -> None:
+    """
+    Write the old Reddit sidebar sections queued by the other tasks in a single wiki edit
+
+    Frequency: 60 seconds
+    """
+
+    redesign.get_sidebar(subreddit).flush()
+
+
 def update_events(subreddit) -> None:
     """
     Update the Upcoming Events section of the sidebar on old Reddit
     """
 
-    # get Calendar widget
-    for widget in subreddit.widgets.sidebar:
-        if widget.shortName == "Upcoming Events":
-            calendar = widget
-            logging.debug("Found Upcoming Events Calendar widget!")
+    # get Calendar widget, refetched since its events are what changes
+    widgets = redesign.get_widgets(subreddit)
+    widgets.refresh()
+    calendar = widgets.find("Upcoming Events")
+    logging.debug("Found Upcoming Events Calendar widget!")
     text = "Name | Starts (UTC) | Location\n"
     text += ":-- | :-: | :--\n"
     for event in calendar.data:
@@ -119,7 +109,7 @@ def dojo_leaderboard(subreddit, stream) -> None:
     Performs the workflow of updating the dojo leaderboard. This includes -
 
     1. ingesting new comments from the Tekken Dojo and adding them to the db
-    2. calculating the leaderboard by querying the db
+    2. ranking the in-memory leaderboard, which ingestion keeps up to date
     3. publishing the results to the sidebar widget
 
     Frequency: 1 day
@@ -132,23 +122,25 @@ def dojo_leaderboard(subreddit, stream) -> None:
     total_comments = dojo.ingest_new(dojo_post, stream)
     logging.info(f"Successfully ingested {total_comments} new comments!")
 
-    # Find (year, month) to tally scores for
     curr = datetime.now()
-    start_timestamp = datetime.fromisoformat(
-        f"{curr.year}-{curr.month:02d}-01 00:00:00.000"
-    )
-    end_timestamp = datetime.fromisoformat(
-        f"{curr.year}-{curr.month:02d}-{calendar.monthrange(curr.year, curr.month)[1]} 23:59:59.999"
-    )
-    logging.debug(
-        f"Finding scores for timestamp range [{start_timestamp}, {end_timestamp}]"
-    )
     logging.debug(f"Finding scores for {curr.year}-{curr.month:02d}")
 
-    leaders = dojo.tally_scores(start_timestamp, end_timestamp)
+    leaders = dojo.current_leaders(curr)
     logging.info(f"Found leaders for {curr.year}-{curr.month:02d}")
     dojo.update_dojo_sidebar(subreddit, leaders, curr)
     logging.info(f"Finished dojo leaderboard workflow for {curr.year}-{curr.month:02d}")
+    logging.debug(f"Storage stats: {storage.get_storage().stats()}")
+
+
+def dojo_reconcile() -> None:
+    """
+    Performs the workflow of checking the in-memory Dojo leaderboard against the db and reloading
+    it if any score has drifted
+
+    Frequency: 30 minutes
+    """
+
+    dojo.reconcile_leaderboard(datetime.now())
 
 
 def dojo_award(reddit, subreddit) -> None:
@@ -196,34 +188,35 @@ def dojo_cleaner() -> None:
 
     Deletes comments which are older than a certain month threshold. This is necessary to ensure db
     does not exceed capacity limits (10000 rows, 1GB) of hobby-dev tier of Heroku PostGreSQL plan.
+    On Postgres whole monthly partitions are dropped, so only months which ended before the cutoff
+    are removed. The cutoff is months in the past, so the current leaderboard is never affected.
 
     Frequency: 5 months (~ 20 weeks)
     """
 
-    conn = dojo.connect_to_db()
-    cur = conn.cursor()
-
     cutoff = datetime.now() - timedelta(weeks=dojo.WEEK_BUFFER)
 
     logging.debug(f"Deleting comments older than datetime {str(cutoff)}")
 
-    cur.execute(
-        psycopg2.sql.SQL(
-            """
-    DELETE FROM {}
-    WHERE created_utc < %s
-    """.format(
-                psycopg2.sql.Identifier(dojo.TABLE_NAME)
-            )
-        ),
-        (cutoff),
-    )
+    try:
+        deleted = storage.get_storage().delete_older_than(cutoff)
+        logging.info(f"Deleted {deleted} rows")
+    except:
+        logging.error(traceback.format_exc())
+
 
-    logging.info(f"Deleted {cur.rowcount} rows")
+def dojo_maintenance() -> None:
+    """
+    Performs the workflow of creating the Dojo tables and the monthly comment partitions ahead of
+    time, so that ingestion never has to wait on DDL
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    Frequency: 1 day
+    """
+
+    try:
+        storage.get_storage().ensure_schema()
+    except:
+        logging.error(traceback.format_exc())
 
 
 def update_dojo_links(subreddit) -> None:
@@ -269,20 +262,21 @@ def update_dojo_links(subreddit) -> None:
     logging.info("Updated top bar menu link")
 
     # Update sidebar widgets (Useful Stuff TextArea + Tekken Dojo ImageWidget)
-    for widget in subreddit.widgets.sidebar:
-        if isinstance(widget, praw.models.TextArea):
-            if "Useful Stuff" in widget.shortName:
-                curr_text = widget.text
-                new_text = curr_text.replace(old_full_link, new_full_link)
-                logging.debug(f"New sidebar widget text: \n{new_text}")
-                widget.mod.update(text=new_text)
-                logging.info("Updated Useful Stuff sidebar link")
-        elif isinstance(widget, praw.models.ImageWidget):
-            if "Tekken Dojo" in widget.shortName:
-                img = widget.data
-                img[0].linkUrl = new_full_link
-                widget.mod.update(data=img)
-                logging.info("Updated Tekken Dojo image link")
+    widgets = redesign.get_widgets(subreddit)
+    widgets.refresh()
+    widget = widgets.find("Useful Stuff", praw.models.TextArea)
+    if widget:
+        curr_text = widget.text
+        new_text = curr_text.replace(old_full_link, new_full_link)
+        logging.debug(f"New sidebar widget text: \n{new_text}")
+        widgets.rename(widget, widget.mod.update(text=new_text))
+        logging.info("Updated Useful Stuff sidebar link")
+    widget = widgets.find("Tekken Dojo", praw.models.ImageWidget)
+    if widget:
+        img = widget.data
+        img[0].linkUrl = new_full_link
+        widgets.rename(widget, widget.mod.update(data=img))
+        logging.info("Updated Tekken Dojo image link")
 
     # update welcome message
     new_welcome_msg_txt = curr_welcome_msg_txt.replace(old_permalink, new_permalink)
@@ -290,11 +284,10 @@ def update_dojo_links(subreddit) -> None:
     logging.info("Updated welcome message text")
 
     # update old sidebar
-    sidebar = subreddit.wiki["config/sidebar"]
-    contents = sidebar.content_md
-    new_content = contents.replace(old_full_link, new_full_link)
-    new_content = new_content.replace(old_permalink, new_permalink)
-    sidebar.edit(new_content)
+    sidebar = redesign.get_sidebar(subreddit)
+    sidebar.replace(old_full_link, new_full_link)
+    sidebar.replace(old_permalink, new_permalink)
+    sidebar.flush()
     logging.info("Updated links in the old sidebar")
 
     # update stylesheet
@@ -1,50 +1,163 @@
 import logging
 import os
+import threading
 import traceback
 from datetime import datetime
-from typing import List, Dict, cast
+from typing import List, Dict, Optional, Tuple, cast
 import time
 
 import requests
 
+import cache
+import metrics
+
 clientID = os.environ.get("TWITCH_CLIENT_ID")
 clientSecret = os.environ.get("TWITCH_SECRET_ID")
 
+OAUTH_URL: str = "https://id.twitch.tv/oauth2/token"
+HELIX_URL: str = "https://api.twitch.tv/helix"
+TWITCH_URL: str = "https://www.twitch.tv"
+REQUEST_TIMEOUT: Tuple[float, float] = (3.05, 10)  # (connect, read) timeouts in seconds
+TOKEN_REFRESH_MARGIN: float = 300  # renew the app token this long before it expires
+LOGIN_CACHE_SIZE: int = 512  # streamers whose login name is kept in memory
+LOGIN_CACHE_TTL: float = 6 * 60 * 60  # seconds before a login name is looked up again
 
-def _get_top_channels_raw(game_id: str, maxLength: int = 5) -> List[Dict[str, str]]:
-    "Get top channels based on game_id"
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_logins = cache.TTLCache(LOGIN_CACHE_SIZE, LOGIN_CACHE_TTL)  # user_id -> login
 
-    oauthURL = "https://id.twitch.tv/oauth2/token"
-    data = {
-        "client_id": clientID,
-        "client_secret": clientSecret,
-        "grant_type": "client_credentials",
-    }
-    try:
-        r = requests.post(oauthURL, data=data)
-    except requests.exceptions.HTTPError as err:
-        logging.error(traceback.format_exc())
-        raise SystemExit(err)
-    if r.status_code != requests.codes.ok:
-        logging.error("Received bad request with code", r.status_code)
-        raise SystemExit
-    access_token = r.json()["access_token"]
 
-    headers = {"Client-ID": clientID, "Authorization": "Bearer " + access_token}
+def get_session() -> requests.Session:
+    "The keep-alive session shared by every Twitch request"
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers["Client-ID"] = clientID or ""
+            _session.hooks["response"].append(metrics.observe_response("twitch"))
+        return _session
+
+
+class TokenManager:
+    """
+    Caches the app access token of the client credentials flow, renewing it TOKEN_REFRESH_MARGIN
+    seconds before it expires or as soon as it is rejected.
+    """
+
+    def __init__(self, client_id: str, client_secret: str) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._token: Optional[str] = None
+        self._expires_at = 0.0  # time.monotonic() after which the token is renewed
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    def token(self) -> str:
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires_at:
+                self._refresh()
+            return self._token
+
+    def invalidate(self) -> None:
+        "Forget the current token, e.g. after it was rejected with a 401"
+
+        with self._lock:
+            self._token = None
+
+    def _refresh(self) -> None:
+        data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "client_credentials",
+        }
+        try:
+            r = get_session().post(OAUTH_URL, data=data, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as err:
+            logging.error(traceback.format_exc())
+            raise SystemExit(err)
+        if r.status_code != requests.codes.ok:
+            logging.error(f"Received bad request with code {r.status_code}")
+            raise SystemExit
+        response = r.json()
+        self._token = response["access_token"]
+        self._expires_at = (
+            time.monotonic() + response.get("expires_in", 0) - TOKEN_REFRESH_MARGIN
+        )
+        self.refreshes += 1
+        logging.debug(
+            f"Renewed Twitch app token, expires in {response.get('expires_in')}s"
+        )
+
+
+_tokens = TokenManager(clientID, clientSecret)
+
+
+def _helix_get(endpoint: str, params) -> dict:
+    """
+    GET a Helix endpoint with the cached app token, renewing the token once if it was rejected
+
+    Returns: the decoded JSON response
+    """
+
+    for attempt in range(2):
+        headers = {"Authorization": "Bearer " + _tokens.token()}
+        try:
+            r = get_session().get(
+                f"{HELIX_URL}/{endpoint}",
+                params=params,
+                headers=headers,
+                timeout=REQUEST_TIMEOUT,
+            )
+            if r.status_code == requests.codes.unauthorized and attempt == 0:
+                logging.warning("Twitch app token was rejected, renewing it")
+                _tokens.invalidate()
+                continue
+            r.raise_for_status()
+        except requests.exceptions.RequestException as err:
+            raise SystemExit(err)
+        return r.json()
+
+
+def _get_logins(user_ids: List[str]) -> Dict[str, str]:
+    """
+    Look up the login names of Twitch users, querying Helix only for users which are not cached
+
+    Returns: user_id -> login of every user found
+    """
+
+    logins = {}
+    missing = []
+    for user_id in user_ids:
+        login = _logins.get(user_id)
+        if login:
+            logins[user_id] = login
+        else:
+            missing.append(user_id)
+
+    if missing:
+        # Need to make additional request to user endpoint since user_name is not display name
+        # Reference: https://github.com/twitchdev/issues/issues/3
+        logging.debug(f"Looking up Twitch users {missing}")
+        users = _helix_get("users", [("id", user_id) for user_id in missing])
+        # Helix does not return users in the order they were asked for, so join on the id
+        for user in users.get("data", []):
+            _logins.put(user["id"], user["login"])
+            logins[user["id"]] = user["login"]
+    logging.debug(
+        f"Twitch login cache: {len(_logins)} entries, {_logins.hits} hits, {_logins.misses} misses"
+    )
+    return logins
+
+
+def _get_top_channels_raw(game_id: str, maxLength: int = 5) -> List[Dict[str, str]]:
+    "Get top channels based on game_id"
 
     top_channels: List[Dict[str, str]] = []
 
     # Getting top channels based on url
-    stream_api_url = (
-        f"https://api.twitch.tv/helix/streams?game_id={game_id}&first={maxLength}"
-    )
-    logging.debug(stream_api_url)
-    try:
-        r = requests.get(stream_api_url, headers=headers)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        raise SystemExit(err)
-    channels = r.json()
+    logging.debug(f"Top {maxLength} streams of game {game_id}")
+    channels = _helix_get("streams", {"game_id": game_id, "first": maxLength})
     logging.debug(channels)
 
     if "data" not in channels:
@@ -52,32 +165,17 @@ def _get_top_channels_raw(game_id: str, maxLength: int = 5) -> List[Dict[str, st
     else:
         channels = channels["data"]
 
-    # Getting user_ids based on channels
-    # Need to make additional request to user endpoint since user_name is not display name
-    # Reference: https://github.com/twitchdev/issues/issues/3
-    user_ids = [stream["user_id"] for stream in channels]
-    logging.debug(user_ids)
-    user_api_url = f"https://api.twitch.tv/helix/users?id={'&id='.join(user_ids)}"
-    logging.debug(user_api_url)
-    try:
-        r = requests.get(user_api_url, headers=headers)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        raise SystemExit(err)
-    users = r.json()
-
-    if "data" not in users:
-        return top_channels
-    else:
-        users = users["data"]
+    logins = _get_logins([stream["user_id"] for stream in channels])
 
-    for stream, user in zip(channels, users):
+    for stream in channels:
+        login_name = logins.get(stream["user_id"])
+        if not login_name:
+            logging.warning(f"No login found for Twitch user {stream['user_id']}")
+            continue
         viewers = stream["viewer_count"]
         status = stream["title"]
         name = stream["user_name"]
-        user_id = stream["user_id"]
-        login_name = user["login"]
-        streamer_url = "https://www.twitch.tv/" + login_name
+        streamer_url = f"{TWITCH_URL}/{login_name}"
 
         # Correcting status for display in Markdown
         if "`" in status: